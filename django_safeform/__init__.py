@@ -1,2 +1,34 @@
+import sys, types
 from decorators import csrf_protect
-from forms import SafeForm, CsrfForm
+
+# The form classes are imported the first time they are used, so code that
+# only needs csrf_utils or csrf_protect does not pay for importing
+# django.forms at startup.
+
+_lazy_attributes = {
+    'SafeForm': 'forms',
+    'CsrfForm': 'forms',
+    'SafeFormSet': 'forms',
+    'SafeFormGroup': 'forms',
+}
+
+__all__ = ['csrf_protect'] + sorted(_lazy_attributes)
+
+class _LazyModule(types.ModuleType):
+    def __getattr__(self, name):
+        try:
+            module_name = _lazy_attributes[name]
+        except KeyError:
+            raise AttributeError(name)
+        module = __import__('%s.%s' % (__name__, module_name), {}, {}, [name])
+        value = getattr(module, name)
+        setattr(self, name, value)
+        return value
+
+# Modules can only get __getattr__ from their class, so swap this module for
+# an instance of _LazyModule with the same contents. The original is kept
+# alive, as Python 2 clears the globals of a module when it is destroyed.
+_module = _LazyModule(__name__, __doc__)
+_module.__dict__.update(sys.modules[__name__].__dict__)
+_module._original_module = sys.modules[__name__]
+sys.modules[__name__] = _module
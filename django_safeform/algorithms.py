@@ -0,0 +1,88 @@
+import hashlib, hmac, re
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.encoding import smart_str
+from django.utils.hashcompat import sha_constructor as sha1
+
+try:
+    from hashlib import blake2b, blake2s
+except ImportError:
+    try:
+        from pyblake2 import blake2b, blake2s
+    except ImportError:
+        blake2b = blake2s = None
+
+# The MAC used to sign tokens is chosen with the CSRF_HASH_ALGORITHM setting.
+# Every algorithm prepares a keyed hash object once per (secret key, cookie),
+# which csrf_utils caches and copy()s for each token - for HMAC that skips
+# hashing the padded key, for BLAKE2 it skips the keyed first block. Tokens
+# record the tag of the algorithm that signed them (SHA-1 tokens have no tag,
+# as they predate the setting), so tokens signed with any algorithm validate
+# whatever the setting is now.
+
+class Algorithm(object):
+    def __init__(self, name, tag, digest_size):
+        self.name = name
+        self.tag = tag
+        self.digest_size = digest_size
+        self.hex_re = re.compile(r'^[0-9a-f]{%d}$' % (digest_size * 2))
+    
+    def available(self):
+        return True
+    
+    def prepare(self, secret_key, cookie):
+        "Returns a keyed hash object, ready to copy() and update()"
+        raise NotImplementedError
+
+class HmacAlgorithm(Algorithm):
+    def __init__(self, name, tag, digestmod):
+        super(HmacAlgorithm, self).__init__(
+            name, tag, digestmod().digest_size
+        )
+        self.digestmod = digestmod
+    
+    def prepare(self, secret_key, cookie):
+        return hmac.new(
+            smart_str(secret_key) + smart_str(cookie), digestmod=self.digestmod
+        )
+
+class Blake2Algorithm(Algorithm):
+    "Keyed BLAKE2 is a MAC by itself, so no HMAC wrapper is needed"
+    
+    def __init__(self, name, tag, constructor, digest_size=20):
+        super(Blake2Algorithm, self).__init__(name, tag, digest_size)
+        self.constructor = constructor
+    
+    def available(self):
+        return self.constructor is not None
+    
+    def prepare(self, secret_key, cookie):
+        # BLAKE2 keys are limited to 32 or 64 bytes, so derive a 32 byte one
+        key = hashlib.sha256(
+            smart_str(secret_key) + '\x00' + smart_str(cookie)
+        ).digest()
+        return self.constructor(key=key, digest_size=self.digest_size)
+
+algorithms = {}
+algorithms_by_tag = {}
+
+def register(algorithm):
+    algorithms[algorithm.name] = algorithm
+    algorithms_by_tag[algorithm.tag] = algorithm
+
+register(HmacAlgorithm('sha1', None, sha1))
+register(HmacAlgorithm('sha256', 's256', hashlib.sha256))
+register(Blake2Algorithm('blake2b', 'b2b', blake2b))
+register(Blake2Algorithm('blake2s', 'b2s', blake2s))
+
+def get_algorithm():
+    name = getattr(settings, 'CSRF_HASH_ALGORITHM', 'sha1')
+    algorithm = algorithms.get(name)
+    if algorithm is None:
+        raise ImproperlyConfigured('Unknown CSRF_HASH_ALGORITHM %s' % name)
+    if not algorithm.available():
+        raise ImproperlyConfigured(
+            'CSRF_HASH_ALGORITHM %s needs Python 3.6 or the pyblake2 '
+            'package' % name
+        )
+    return algorithm
@@ -0,0 +1,369 @@
+import gc
+from timeit import default_timer
+from django import forms
+from django.http import HttpRequest, HttpResponse, QueryDict
+from django.utils import simplejson
+from django_safeform import csrf_utils
+from django_safeform.decorators import csrf_protect
+from django_safeform.engines import get_token_engine
+from django_safeform.forms import SafeForm
+
+# Benchmarks for the hot paths - run them with "./manage.py csrf_benchmark".
+# Each benchmark is a setup function, registered with @benchmark, which does
+# any preparation and returns a function that performs one operation. Only
+# calls to that function are timed.
+
+registry = []
+
+def benchmark(name):
+    def register(setup):
+        registry.append((name, setup))
+        return setup
+    return register
+
+def make_request(cookie='benchmark-cookie', method='GET', data=None):
+    request = HttpRequest()
+    request.method = method
+    if cookie:
+        request.COOKIES[get_token_engine().cookie_name] = cookie
+    if data is not None:
+        request.POST = QueryDict('').copy()
+        request.POST.update(data)
+        request.POST._mutable = False
+    return request
+
+def _old_token(request, identifier='default'):
+    "A token issued an hour ago"
+    from django_safeform.clock import FixedClock, get_clock, set_clock
+    orig_clock = get_clock()
+    set_clock(FixedClock(orig_clock.now() - 60 * 60))
+    try:
+        return csrf_utils.new_csrf_token(request, identifier)
+    finally:
+        set_clock(orig_clock)
+
+@benchmark('new_csrf_token')
+def bench_new_csrf_token():
+    request = make_request()
+    return lambda: csrf_utils.new_csrf_token(request)
+
+@benchmark('validate_csrf_token:valid')
+def bench_validate_valid():
+    request = make_request()
+    token = csrf_utils.new_csrf_token(request)
+    return lambda: csrf_utils.validate_csrf_token(token, request)
+
+@benchmark('validate_csrf_token:bad_signature')
+def bench_validate_bad_signature():
+    request = make_request()
+    token = csrf_utils.new_csrf_token(request)
+    token = token[:-1] + (token[-1] == '0' and '1' or '0')
+    return lambda: csrf_utils.validate_csrf_token(token, request)
+
+@benchmark('validate_csrf_token:expired')
+def bench_validate_expired():
+    request = make_request()
+    token = _old_token(request)
+    return lambda: csrf_utils.validate_csrf_token(
+        token, request, expire_after=60
+    )
+
+@benchmark('validate_csrf_token:wrong_identifier')
+def bench_validate_wrong_identifier():
+    request = make_request()
+    token = csrf_utils.new_csrf_token(request, 'other')
+    return lambda: csrf_utils.validate_csrf_token(token, request)
+
+# Tokens that are turned away before their signature is checked
+
+@benchmark('validate_csrf_token:junk')
+def bench_validate_junk():
+    request = make_request()
+    return lambda: csrf_utils.validate_csrf_token('x' * 40, request)
+
+@benchmark('validate_csrf_token:oversized')
+def bench_validate_oversized():
+    request = make_request()
+    token = 'default:1253232000:' + 'a' * 100000
+    return lambda: csrf_utils.validate_csrf_token(token, request)
+
+@benchmark('validate_csrf_token:forged_expired')
+def bench_validate_forged_expired():
+    request = make_request()
+    token = 'default:1253232000:%s' % ('0' * 40)
+    return lambda: csrf_utils.validate_csrf_token(
+        token, request, expire_after=60
+    )
+
+class BenchmarkForm(forms.Form):
+    name = forms.CharField(max_length = 100)
+    email = forms.EmailField()
+SafeBenchmarkForm = SafeForm(BenchmarkForm)
+
+FORM_DATA = {'name': 'Simon', 'email': 'simon@example.com'}
+
+@benchmark('form:construct:plain')
+def bench_construct_plain():
+    return lambda: BenchmarkForm()
+
+@benchmark('form:construct:safe')
+def bench_construct_safe():
+    request = make_request()
+    return lambda: SafeBenchmarkForm(request)
+
+@benchmark('form:render:plain')
+def bench_render_plain():
+    return lambda: BenchmarkForm().as_p()
+
+@benchmark('form:render:safe')
+def bench_render_safe():
+    request = make_request()
+    return lambda: SafeBenchmarkForm(request).as_p()
+
+@benchmark('form:is_valid:plain')
+def bench_is_valid_plain():
+    request = make_request(method='POST', data=FORM_DATA)
+    return lambda: BenchmarkForm(request.POST).is_valid()
+
+@benchmark('form:is_valid:safe')
+def bench_is_valid_safe():
+    data = dict(FORM_DATA)
+    data['csrf_token'] = csrf_utils.new_csrf_token(make_request())
+    request = make_request(method='POST', data=data)
+    return lambda: SafeBenchmarkForm(request, request.POST).is_valid()
+
+def _view(request):
+    return HttpResponse('OK')
+
+@benchmark('csrf_protect:plain_view')
+def bench_plain_view():
+    request = make_request()
+    return lambda: _view(request)
+
+@benchmark('csrf_protect:with_cookie')
+def bench_protect_with_cookie():
+    view = csrf_protect(_view)
+    request = make_request()
+    return lambda: view(request)
+
+@benchmark('csrf_protect:without_cookie')
+def bench_protect_without_cookie():
+    view = csrf_protect(_view)
+    return lambda: view(make_request(cookie=None))
+
+@benchmark('cookie_secret')
+def bench_cookie_secret():
+    from django_safeform.cookies import new_cookie_secret
+    return new_cookie_secret
+
+@benchmark('cookie_secret:sha1_random')
+def bench_cookie_secret_sha1_random():
+    # How cookies were generated before, for comparison
+    import random
+    from django.utils.hashcompat import sha_constructor as sha1
+    return lambda: sha1(str(random.random())).hexdigest()
+
+def _admin_page(size):
+    "Roughly size bytes of form-heavy HTML"
+    row = ('<tr><td><input type="checkbox" name="_selected_action" '
+        'value="%d" class="action-select"></td>\n<td><a href="%d/">Row '
+        '%d</a></td></tr>\n')
+    rows = []
+    length = 0
+    i = 0
+    while length < size:
+        rows.append(row % (i, i, i))
+        length += len(rows[-1])
+        i += 1
+    return ('<form method="post"><input type="hidden" name="csrf_token" '
+        'value="token"><table>%s</table></form>' % ''.join(rows))
+
+def _bench_extract(size):
+    def setup():
+        from django_safeform.test_utils import extract_input_tags
+        html = _admin_page(size)
+        return lambda: extract_input_tags(html)
+    return setup
+
+for size, label in ((10000, '10KB'), (100000, '100KB'), (1000000, '1MB')):
+    benchmark('extract_input_tags:%s' % label)(_bench_extract(size))
+
+# Pairs of benchmarks where the second does ten times the work of the first,
+# so should take about ten times as long. Quadratic behaviour would be
+# closer to a hundred.
+SCALING_CHECKS = (
+    ('extract_input_tags:10KB', 'extract_input_tags:100KB'),
+    ('extract_input_tags:100KB', 'extract_input_tags:1MB'),
+)
+
+# Signing a token-sized message with each available MAC algorithm, from the
+# prepared state that csrf_utils caches, and from scratch for comparison
+
+TOKEN_MESSAGE = 'default:1253232000'
+
+def _bench_sign(algorithm, prepared=True):
+    def setup():
+        from django.conf import settings
+        from django_safeform.csrf_utils import _sign
+        if prepared:
+            state = algorithm.prepare(settings.SECRET_KEY, 'benchmark-cookie')
+            return lambda: _sign(state, TOKEN_MESSAGE)
+        return lambda: _sign(algorithm.prepare(
+            settings.SECRET_KEY, 'benchmark-cookie'
+        ), TOKEN_MESSAGE)
+    return setup
+
+def _register_sign_benchmarks():
+    from django_safeform.algorithms import algorithms
+    for name in sorted(algorithms):
+        if algorithms[name].available():
+            benchmark('sign:%s' % name)(_bench_sign(algorithms[name]))
+            benchmark('sign:%s:unprepared' % name)(
+                _bench_sign(algorithms[name], prepared=False)
+            )
+_register_sign_benchmarks()
+
+# Cold start: importing the package in a fresh Python process, with the same
+# path and settings as this one
+
+def fresh_import(statement):
+    "Runs statement in a new interpreter, returns the modules it imported"
+    import os, subprocess, sys
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(sys.path)
+    process = subprocess.Popen([sys.executable, '-c',
+        '%s\nimport sys\nprint "\\n".join(sys.modules)' % statement
+    ], stdout=subprocess.PIPE, env=env)
+    output = process.communicate()[0]
+    if process.returncode:
+        raise RuntimeError('Could not run %r' % statement)
+    return output.split()
+
+@benchmark('import:csrf_utils')
+def bench_import_csrf_utils():
+    return lambda: fresh_import('import django_safeform.csrf_utils')
+
+@benchmark('import:SafeForm')
+def bench_import_safe_form():
+    return lambda: fresh_import('from django_safeform import SafeForm')
+
+def _time(fn, number):
+    start = default_timer()
+    for i in xrange(number):
+        fn()
+    return default_timer() - start
+
+def _allocations(fn, number):
+    """
+    Container objects still alive after number calls, per call. This is
+    what the garbage collector can see without tracemalloc, which is not
+    available on the Pythons we support - it catches leaks and unbounded
+    caches rather than short-lived garbage.
+    """
+    gc.collect()
+    before = len(gc.get_objects())
+    for i in xrange(number):
+        fn()
+    gc.collect()
+    return float(len(gc.get_objects()) - before) / number
+
+def run_benchmark(setup, min_time=0.2, repeat=3):
+    "Returns {'ops_per_sec': ..., 'allocations': ...} for one benchmark"
+    fn = setup()
+    fn() # Warm up any caches
+    # Find a number of calls that takes at least min_time
+    number = 1
+    while True:
+        elapsed = _time(fn, number)
+        if elapsed >= min_time or number >= 10 ** 7:
+            break
+        number *= 10
+    best = min([elapsed] + [_time(fn, number) for i in range(repeat - 1)])
+    return {
+        'ops_per_sec': number / max(best, 1e-9),
+        'allocations': _allocations(fn, min(number, 1000)),
+    }
+
+def run_benchmarks(names=None, min_time=0.2, repeat=3, engine=None):
+    """
+    Returns a dictionary of results, keyed on benchmark name. engine is the
+    dotted path to a token engine to use in place of CSRF_TOKEN_ENGINE.
+    """
+    from django.conf import settings
+    from django_safeform.engines import DEFAULT_ENGINE
+    orig_engine = getattr(settings, 'CSRF_TOKEN_ENGINE', DEFAULT_ENGINE)
+    if engine is not None:
+        settings.CSRF_TOKEN_ENGINE = engine
+        get_token_engine() # Fail early if it cannot be loaded
+    try:
+        results = {}
+        for name, setup in registry:
+            if names and name not in names:
+                continue
+            results[name] = run_benchmark(setup, min_time, repeat)
+    finally:
+        if engine is not None:
+            settings.CSRF_TOKEN_ENGINE = orig_engine
+    return results
+
+def save_baseline(results, path):
+    fp = open(path, 'w')
+    try:
+        fp.write(simplejson.dumps(results, indent=4, sort_keys=True))
+    finally:
+        fp.close()
+
+def load_baseline(path):
+    fp = open(path)
+    try:
+        return simplejson.loads(fp.read())
+    finally:
+        fp.close()
+
+def find_regressions(results, baseline, threshold=10):
+    """
+    Returns (name, baseline ops/sec, current ops/sec) for every benchmark
+    that is more than threshold percent slower than the baseline
+    """
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        before = baseline[name]['ops_per_sec']
+        after = results[name]['ops_per_sec']
+        if after < before * (1 - threshold / 100.0):
+            regressions.append((name, before, after))
+    return regressions
+
+def find_scaling_problems(results, max_ratio=30):
+    """
+    Returns (small, large, slowdown) for every SCALING_CHECKS pair where the
+    larger input is more than max_ratio times slower. The default leaves
+    plenty of slack for noisy machines.
+    """
+    problems = []
+    for small, large in SCALING_CHECKS:
+        if small not in results or large not in results:
+            continue
+        ratio = results[small]['ops_per_sec'] / results[large]['ops_per_sec']
+        if ratio > max_ratio:
+            problems.append((small, large, ratio))
+    return problems
+
+def format_results(results, baseline=None):
+    lines = ['%-40s %14s %12s %9s' % (
+        'benchmark', 'ops/sec', 'allocs/op', 'change'
+    )]
+    for name, setup in registry:
+        if name not in results:
+            continue
+        result = results[name]
+        change = ''
+        if baseline and name in baseline:
+            change = '%+.1f%%' % (100.0 * (
+                result['ops_per_sec'] / baseline[name]['ops_per_sec'] - 1
+            ))
+        lines.append('%-40s %14.1f %12.2f %9s' % (
+            name, result['ops_per_sec'], result['allocations'], change
+        ))
+    return '\n'.join(lines)
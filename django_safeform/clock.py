@@ -0,0 +1,41 @@
+import threading, time
+
+# Every token timestamp comes from a clock object with a now() method
+# returning whole seconds since the epoch. Tests can swap in their own clock
+# for the current thread without touching global state, so they can run in
+# parallel.
+
+class SystemClock(object):
+    "Wall clock time from time.time(), corrected so it never runs backwards"
+    
+    def __init__(self):
+        self._last = 0
+    
+    def now(self):
+        now = int(time.time())
+        if now < self._last:
+            # The system clock was stepped back - hold still until it
+            # catches up rather than issuing tokens from the past
+            return self._last
+        self._last = now
+        return now
+
+class FixedClock(object):
+    "A clock that always returns the same time, for use in tests"
+    
+    def __init__(self, epoch_time):
+        self.epoch_time = int(epoch_time)
+    
+    def now(self):
+        return self.epoch_time
+
+default_clock = SystemClock()
+
+_local = threading.local()
+
+def get_clock():
+    return getattr(_local, 'clock', None) or default_clock
+
+def set_clock(clock):
+    "Sets the clock used by the current thread - None restores the default"
+    _local.clock = clock
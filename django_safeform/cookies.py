@@ -0,0 +1,40 @@
+import base64, os, threading
+
+# Values for new _csrf_cookies come from os.urandom. Asking the OS for a
+# few bytes at a time costs a system call per visitor, so random bytes are
+# fetched in blocks and base64 encoded in one go, then handed out a slice at
+# a time under a lock.
+
+class SecretGenerator(object):
+    "Hands out random URL-safe strings of a fixed length"
+    
+    def __init__(self, num_bytes=24, per_block=128, urandom=os.urandom):
+        if num_bytes % 3:
+            # Each 3 bytes encode to 4 characters without padding, so a
+            # slice of the encoded block is the encoding of a slice of bytes
+            raise ValueError('num_bytes must be a multiple of 3')
+        self.length = num_bytes // 3 * 4
+        self.block_bytes = num_bytes * per_block
+        self.urandom = urandom
+        self._lock = threading.Lock()
+        self._buffer = ''
+        self._pos = 0
+        self._pid = None
+    
+    def __call__(self):
+        self._lock.acquire()
+        try:
+            # A forked worker must not hand out the same values as its parent
+            if self._pos >= len(self._buffer) or self._pid != os.getpid():
+                self._buffer = base64.urlsafe_b64encode(
+                    self.urandom(self.block_bytes)
+                )
+                self._pos = 0
+                self._pid = os.getpid()
+            pos = self._pos
+            self._pos = pos + self.length
+            return self._buffer[pos:self._pos]
+        finally:
+            self._lock.release()
+
+new_cookie_secret = SecretGenerator()
@@ -1,46 +1,473 @@
-import time, datetime, hmac
+import base64, binascii, hmac, re, struct
+from timeit import default_timer
 from django.utils.hashcompat import sha_constructor as sha1
+from django.utils.encoding import smart_str
 from django.conf import settings
+from lru import LRUCache
+from clock import get_clock
+from keys import get_keyring, key_id
+from stores import get_used_token_store
+from stats import get_stats, metric_name, per_identifier
+from injection import placeholder
+from cookies import SecretGenerator
+from algorithms import get_algorithm, algorithms_by_tag
+from engines import get_token_engine
 
-def _csrf_token_from_request(request):
-    if hasattr(request, '_csrf_token_to_set'):
-        return request._csrf_token_to_set
-    return request.COOKIES.get('_csrf_cookie', '')
+# Prepared HMAC objects keyed on (algorithm, secret key, cookie). Running the
+# derived key through the HMAC pads costs more than signing the short token
+# message, so we do it once per cookie and copy() the prepared state for every
+# token. Having the secret key in the cache key means changing it invalidates
+# old entries.
+hmac_cache = LRUCache(max_size = 1000)
 
-def new_csrf_token(request, identifier='default'):
-    epoch_time = int(
-        time.mktime(datetime.datetime.utcnow().timetuple())
-    )
+def _prepared_hmac(algorithm, secret_key, cookie):
+    cache_key = (algorithm.name, secret_key, cookie)
+    prepared = hmac_cache.get(cache_key)
+    if prepared is None:
+        prepared = algorithm.prepare(secret_key, cookie)
+        hmac_cache.set(cache_key, prepared)
+    return prepared
+
+class _RequestKeys(object):
+    "Prepared HMAC state for each key id needed while handling a request"
+    
+    def __init__(self, cookie):
+        self.cookie = cookie
+        self.keyring = get_keyring()
+        self._prepared = {}
+    
+    def prepared(self, kid, algorithm):
+        "Returns prepared HMAC state for kid, or None for an unknown kid"
+        try:
+            return self._prepared[kid, algorithm.name]
+        except KeyError:
+            pass
+        if kid is None:
+            # Tokens issued before key ids existed were signed with SECRET_KEY,
+            # and are only accepted while it is still one of the active keys
+            secret_key = self.keyring.get(key_id(settings.SECRET_KEY))
+        else:
+            secret_key = self.keyring.get(kid)
+        prepared = None
+        if secret_key is not None:
+            prepared = _prepared_hmac(algorithm, secret_key, self.cookie)
+        self._prepared[kid, algorithm.name] = prepared
+        return prepared
+
+def _sign(prepared, message):
+    mac = prepared.copy()
+    mac.update(message)
+    return mac.hexdigest()
+
+def _sign_bytes(prepared, message):
+    mac = prepared.copy()
+    mac.update(message)
+    return mac.digest()
+
+def _epoch_time():
+    return get_clock().now()
+
+# Tokens come in two formats. The original "hex" format is
+#
+#     identifier:epoch_time:key_id.hex-signature
+#
+# where key_id is preceded by the algorithm tag and a "-" for anything other
+# than SHA-1 - see algorithms.py. The "compact" format is the version prefix
+# "2.", the key id (tagged the same way) and a "."
+# followed by the URL-safe base64 encoding (without padding) of an 18 byte
+# structure:
+#
+#     4 bytes  epoch_time, big-endian unsigned
+#     4 bytes  leading bytes of the SHA1 of the identifier
+#    10 bytes  leading bytes of the HMAC of the above plus the identifier
+#
+# The length does not depend on the identifier: a SHA-1 token is 31
+# characters, and the algorithm tag or a single-use nonce (below) make it a
+# little longer.
+#
+# Single-use tokens also carry a random nonce, so that no two are the same
+# even when issued in the same second. In the hex format it follows the time,
+# as epoch_time-nonce. In the compact format 6 random bytes follow the time,
+# making a 24 byte structure. The nonce is signed along with everything else.
+# The used token store remembers them by key id and signature rather than by
+# the whole token, as the key id is not signed and could otherwise be
+# dropped to get a "different" token that is still valid.
+#
+# Which format is
+# issued is controlled by the CSRF_TOKEN_FORMAT setting - both are accepted
+# by validate_csrf_token, so switching formats does not invalidate tokens in
+# forms that are already out there. Tokens without a key id were issued by
+# earlier versions, and are checked against SECRET_KEY as long as it is
+# still an active key.
+
+COMPACT_PREFIX = '2.'
+COMPACT_STRUCT = '>I4s10s'
+
+def _identifier_hash(identifier):
+    return sha1(smart_str(identifier)).digest()[:4]
+
+COMPACT_NONCE_STRUCT = '>I6s4s10s'
+
+# 8 URL-safe characters from 6 random bytes
+new_nonce = SecretGenerator(num_bytes=6)
+nonce_re = re.compile(r'^[A-Za-z0-9_-]{8}$')
+
+def _compact_message(packed_time, id_hash, identifier, nonce_bytes=''):
+    # The leading version byte keeps these messages distinct from anything
+    # signed for a hex format token, and from each other
+    if nonce_bytes:
+        return '\x03%s%s%s%s' % (
+            packed_time, nonce_bytes, id_hash, smart_str(identifier)
+        )
+    return '\x02%s%s%s' % (packed_time, id_hash, smart_str(identifier))
+
+def _make_hex_token(prepared, kid, identifier, epoch_time, nonce=None):
     message = '%s:%s' % (identifier, epoch_time)
-    secret_key = settings.SECRET_KEY + _csrf_token_from_request(request)
-    sig = hmac.new(secret_key, message, sha1).hexdigest()
-    return '%s:%s' % (message, sig)
+    if nonce is not None:
+        message = '%s-%s' % (message, nonce)
+    return '%s:%s.%s' % (message, kid, _sign(prepared, message))
+
+def _make_compact_token(prepared, kid, identifier, epoch_time, nonce=None):
+    packed_time = struct.pack('>I', epoch_time)
+    nonce_bytes = ''
+    if nonce is not None:
+        nonce_bytes = base64.urlsafe_b64decode(nonce)
+    id_hash = _identifier_hash(identifier)
+    mac = _sign_bytes(prepared,
+        _compact_message(packed_time, id_hash, identifier, nonce_bytes)
+    )
+    return '%s%s.%s' % (COMPACT_PREFIX, kid, base64.urlsafe_b64encode(
+        packed_time + nonce_bytes + id_hash + mac[:10]
+    ))
+
+_token_makers = {
+    'hex': _make_hex_token,
+    'compact': _make_compact_token,
+}
+
+def _token_maker():
+    return _token_makers[getattr(settings, 'CSRF_TOKEN_FORMAT', 'hex')]
+
+# Issued tokens keyed on (format, algorithm, secret key, cookie, identifier,
+# epoch_time).
+# Only used when CSRF_TOKEN_TIME_BUCKET is set, as that is the only time the
+# same token is issued more than once.
+token_cache = LRUCache(max_size = 10000)
+
+def new_csrf_token(request, identifier='default', single_use=False):
+    return new_csrf_tokens(request, [identifier], single_use)[0]
+
+def new_csrf_tokens(request, identifiers, single_use=False):
+    """
+    Returns a list of tokens, one for each of the identifiers, in order.
+    Pass single_use=True for tokens that will be checked with single_use=True,
+    so that each one is unique.
+    """
+    if getattr(request, '_csrf_placeholders', False):
+        # csrf_protect will swap these for real tokens - see injection.py
+        return [
+            placeholder(identifier, single_use) for identifier in identifiers
+        ]
+    # Tells csrf_protect(lazy_cookie=True) that the cookie is needed
+    request._csrf_token_issued = True
+    engine = get_token_engine()
+    # Only passed when needed, so engines without single-use tokens can
+    # leave the argument out
+    args = single_use and (True,) or ()
+    stats = get_stats()
+    if not stats.enabled:
+        return engine.issue(request, identifiers, *args)
+    start = default_timer()
+    tokens = engine.issue(request, identifiers, *args)
+    stats.timing('issue', default_timer() - start)
+    stats.incr('issued', len(identifiers))
+    if per_identifier():
+        for identifier in identifiers:
+            stats.incr(metric_name('issued', identifier))
+    return tokens
+
+class LazyCsrfToken(object):
+    """
+    Stands in for new_csrf_token(request, identifier, single_use), which is
+    only called the first time the token is rendered or called, and then
+    remembered. Form fields call it when they render, so an unrendered form
+    costs no HMAC.
+    """
+    
+    def __init__(self, request, identifier='default', single_use=False):
+        self.request = request
+        self.identifier = identifier
+        self.single_use = single_use
+        self._token = None
+    
+    def __call__(self):
+        if self._token is None:
+            self._token = new_csrf_token(
+                self.request, self.identifier, self.single_use
+            )
+        return self._token
+    
+    def __str__(self):
+        return str(self())
+    
+    def __unicode__(self):
+        return unicode(self())
+
+def _new_csrf_tokens(cookie, identifiers, single_use=False):
+    "The signing behind the default engines.HmacTokenEngine"
+    make_token = _token_maker()
+    algorithm = get_algorithm()
+    epoch_time = _epoch_time()
+    keys = _RequestKeys(cookie)
+    kid = keys.keyring.signing_kid
+    label = kid
+    if algorithm.tag is not None:
+        label = '%s-%s' % (algorithm.tag, kid)
+    if single_use:
+        # Never bucketed, as every token must be different
+        prepared = keys.prepared(kid, algorithm)
+        return [
+            make_token(prepared, label, identifier, epoch_time, new_nonce())
+            for identifier in identifiers
+        ]
+    bucket = getattr(settings, 'CSRF_TOKEN_TIME_BUCKET', None)
+    if not bucket or bucket <= 1:
+        prepared = keys.prepared(kid, algorithm)
+        return [
+            make_token(prepared, label, identifier, epoch_time)
+            for identifier in identifiers
+        ]
+    # Round down to the start of the bucket, so every render of the same
+    # form within the bucket gets an identical token
+    epoch_time -= epoch_time % bucket
+    secret_key = keys.keyring.signing_key
+    tokens = []
+    for identifier in identifiers:
+        cache_key = (make_token, algorithm.name, secret_key, keys.cookie,
+            identifier, epoch_time
+        )
+        token = token_cache.get(cache_key)
+        if token is None:
+            token = make_token(
+                keys.prepared(kid, algorithm), label, identifier, epoch_time
+            )
+            token_cache.set(cache_key, token)
+        tokens.append(token)
+    return tokens
 
 not_set = object()
 
-def validate_csrf_token(token, request, identifier='default', 
-        expire_after=not_set):
-    if not ':' in token:
+def _constant_time_compare(val1, val2):
+    "Compares two strings in time that depends only on their length"
+    if len(val1) != len(val2):
         return False
+    result = 0
+    for x, y in zip(val1, val2):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+constant_time_compare = getattr(hmac, 'compare_digest', _constant_time_compare)
+
+# Tokens are checked in order of cost. Everything that can be checked without
+# the secret key - the length, the characters used, the timestamp, the
+# identifier and the expiry - is checked first, so junk and stale tokens are
+# turned away without computing an HMAC. Nothing is accepted until the
+# signature has been checked as well.
+MAX_TOKEN_LENGTH = 1000
+compact_encoded_re = re.compile(r'^(?:[A-Za-z0-9_-]{24}|[A-Za-z0-9_-]{32})$')
+
+def _split_kid(signature):
+    if '.' in signature:
+        return signature.split('.', 1)
+    return None, signature
+
+def _split_algorithm(label):
+    "Returns (algorithm, kid) - the algorithm is None if we cannot use it"
+    if label is not None and '-' in label:
+        tag, kid = label.split('-', 1)
+        algorithm = algorithms_by_tag.get(tag)
+        if algorithm is None or not algorithm.available():
+            return None, kid
+        return algorithm, kid
+    return algorithms_by_tag[None], label
+
+# The _check functions return None for a valid token, or the reason it was
+# rejected - one of stats.REJECTION_REASONS
+
+def _check_token(keys, token, identifier, expire_after, epoch_time):
+    if not token:
+        return 'missing'
+    if len(token) > MAX_TOKEN_LENGTH:
+        return 'malformed'
+    if not ':' in token:
+        if token.startswith(COMPACT_PREFIX):
+            return _check_compact_token(
+                keys, token, identifier, expire_after, epoch_time
+            )
+        return 'malformed'
     message, signature = token.rsplit(':', 1)
-    secret_key = settings.SECRET_KEY + _csrf_token_from_request(request)
-    expected_sig = hmac.new(secret_key, message, sha1).hexdigest()
-    if signature != expected_sig:
-        return False
+    label, signature = _split_kid(signature)
+    algorithm, kid = _split_algorithm(label)
+    if algorithm is None or not ':' in message \
+            or not algorithm.hex_re.match(signature):
+        return 'malformed'
+    token_identifier, created_at = message.rsplit(':', 1)
+    if '-' in created_at:
+        created_at, nonce = created_at.split('-', 1)
+        if not nonce_re.match(nonce):
+            return 'malformed'
+    if not created_at.isdigit():
+        return 'malformed'
     
     # Check the expiry and identifier
-    token_identifier, created_at = message.split(':', 1)
     if token_identifier != identifier:
-        return False
-    
-    if expire_after is not_set:
-        expire_after = getattr(settings, 'CSRF_TOKENS_EXPIRE_AFTER', None)
+        return 'wrong_identifier'
     
     if expire_after is not None:
-        epoch_time = int(
-            time.mktime(datetime.datetime.utcnow().timetuple())
-        )
         if int(created_at) + expire_after < epoch_time:
-            return False
+            return 'expired'
+    
+    prepared = keys.prepared(kid, algorithm)
+    if prepared is None:
+        return 'unknown_key'
+    # The regex match means str() is safe, and compare_digest will not
+    # compare unicode with str
+    if not constant_time_compare(str(signature), _sign(prepared, message)):
+        return 'bad_signature'
+    
+    return None
+
+def _check_compact_token(keys, token, identifier, expire_after, epoch_time):
+    label, encoded = _split_kid(token[len(COMPACT_PREFIX):])
+    algorithm, kid = _split_algorithm(label)
+    if algorithm is None or not compact_encoded_re.match(encoded):
+        return 'malformed'
+    try:
+        packed = base64.urlsafe_b64decode(encoded)
+    except (TypeError, ValueError, binascii.Error):
+        return 'malformed'
+    nonce_bytes = ''
+    if len(packed) == struct.calcsize(COMPACT_STRUCT):
+        created_at, id_hash, signature = struct.unpack(COMPACT_STRUCT, packed)
+    elif len(packed) == struct.calcsize(COMPACT_NONCE_STRUCT):
+        created_at, nonce_bytes, id_hash, signature = struct.unpack(
+            COMPACT_NONCE_STRUCT, packed
+        )
+    else:
+        return 'malformed'
+    if id_hash != _identifier_hash(identifier):
+        return 'wrong_identifier'
     
-    return True
+    if expire_after is not None:
+        if created_at + expire_after < epoch_time:
+            return 'expired'
+    
+    prepared = keys.prepared(kid, algorithm)
+    if prepared is None:
+        return 'unknown_key'
+    expected_sig = _sign_bytes(prepared, _compact_message(
+        packed[:4], id_hash, identifier, nonce_bytes
+    ))[:10]
+    if not constant_time_compare(signature, expected_sig):
+        return 'bad_signature'
+    
+    return None
+
+def validate_csrf_token(token, request, identifier='default', 
+        expire_after=not_set, single_use=False):
+    return validate_csrf_tokens(request, [(token, identifier)],
+        expire_after=expire_after, single_use=single_use
+    )[0]
+
+def validate_csrf_tokens(request, tokens_and_identifiers,
+        expire_after=not_set, single_use=False):
+    "Validates a list of (token, identifier) pairs, returns a list of bools"
+    return [reason is None for reason in check_csrf_tokens(
+        request, tokens_and_identifiers, expire_after, single_use
+    )]
+
+def check_csrf_tokens(request, tokens_and_identifiers,
+        expire_after=not_set, single_use=False):
+    """
+    Like validate_csrf_tokens, but returns None for each valid token and the
+    reason for rejecting each invalid one - see stats.REJECTION_REASONS
+    """
+    stats = get_stats()
+    if not stats.enabled:
+        return _check_tokens(
+            request, tokens_and_identifiers, expire_after, single_use
+        )
+    tokens_and_identifiers = list(tokens_and_identifiers)
+    start = default_timer()
+    reasons = _check_tokens(
+        request, tokens_and_identifiers, expire_after, single_use
+    )
+    stats.timing('validate', default_timer() - start)
+    by_identifier = per_identifier()
+    for (token, identifier), reason in zip(tokens_and_identifiers, reasons):
+        if reason is None:
+            stats.incr('accepted')
+            if by_identifier:
+                stats.incr(metric_name('accepted', identifier))
+        else:
+            stats.incr('rejected.%s' % reason)
+            if by_identifier:
+                stats.incr(metric_name('rejected', reason, identifier))
+    return reasons
+
+def _check_tokens(request, tokens_and_identifiers, expire_after, single_use):
+    if expire_after is not_set:
+        expire_after = getattr(settings, 'CSRF_TOKENS_EXPIRE_AFTER', None)
+    store = None
+    if single_use:
+        # A used token is only remembered for the store's TTL, so it must
+        # not be accepted after that either
+        store = get_used_token_store()
+        if expire_after is None or expire_after > store.ttl:
+            expire_after = store.ttl
+    tokens_and_identifiers = list(tokens_and_identifiers)
+    engine = get_token_engine()
+    reasons = engine.check(request, tokens_and_identifiers, expire_after)
+    if store is not None:
+        for i, (token, identifier) in enumerate(tokens_and_identifiers):
+            if reasons[i] is not None:
+                continue
+            key = engine.single_use_key(token)
+            if key is None:
+                reasons[i] = 'malformed'
+            elif not store.add(key, expire_after):
+                reasons[i] = 'already_used'
+    limiter = getattr(request, '_csrf_failure_limiter', None)
+    if limiter is not None:
+        for reason in reasons:
+            if reason is not None:
+                limiter.record_failure(request)
+    return reasons
+
+def _single_use_key(token):
+    """
+    Returns the key id and signature of a valid token, or None if it has no
+    key id or no nonce and so was not issued for single use
+    """
+    if not ':' in token:
+        label, encoded = _split_kid(token[len(COMPACT_PREFIX):])
+        if label is None or len(encoded) != 32:
+            return None
+        signature = encoded
+    else:
+        message, signature = token.rsplit(':', 1)
+        label, signature = _split_kid(signature)
+        if label is None or not '-' in message.rsplit(':', 1)[1]:
+            return None
+    return str('%s.%s' % (label, signature))
+
+def _check_signed_tokens(cookie, tokens_and_identifiers, expire_after):
+    "The checks behind the default engines.HmacTokenEngine"
+    epoch_time = None
+    if expire_after is not None:
+        epoch_time = _epoch_time()
+    keys = _RequestKeys(cookie)
+    return [
+        _check_token(keys, token, identifier, expire_after, epoch_time)
+        for token, identifier in tokens_and_identifiers
+    ]
@@ -1,20 +1,98 @@
-from django.utils.hashcompat import sha_constructor as sha1
-import random
+import inspect
+from django.utils.cache import patch_vary_headers
+from csrf_utils import new_csrf_token
+from engines import get_token_engine
+from injection import inject_into_response, substitute_in_response
+from limiter import get_failure_limiter
+from uploads import check_before_body
 try:
     from functools import wraps
 except ImportError:
     from django.utils.functional import wraps  # Python 2.3, 2.4 fallback.
 
-def csrf_protect(view_func):
+def _process_request(request):
+    "Ensures the request has a cookie to tie tokens to - returns it if new"
+    engine = get_token_engine()
+    csrf_token = request.COOKIES.get(engine.cookie_name)
+    if not csrf_token:
+        csrf_token = engine.new_cookie()
+        request._csrf_token_to_set = csrf_token
+        return csrf_token
+    return None
+
+def _process_response(request, response, new_cookie, inject_tokens=False,
+        placeholder_tokens=False, lazy_cookie=False):
+    if placeholder_tokens:
+        # From here on new_csrf_token hands out real tokens again
+        request._csrf_placeholders = False
+        substitute_in_response(response,
+            lambda identifier, single_use: new_csrf_token(
+                request, identifier, single_use
+            )
+        )
+    if inject_tokens:
+        inject_into_response(response, lambda: new_csrf_token(request),
+            origin = '%s://%s' % (
+                request.is_secure() and 'https' or 'http', request.get_host()
+            ),
+        )
+    if lazy_cookie:
+        # Streaming responses may still issue tokens as they are sent, so 
+        # assume that they do
+        if getattr(request, '_csrf_token_issued', False) \
+                or not response._is_string:
+            # The page holds a token that only works with this cookie
+            patch_vary_headers(response, ('Cookie',))
+        else:
+            # Leave the response free of Set-Cookie, so it can be cached
+            new_cookie = None
+    if new_cookie:
+        get_token_engine().set_cookie(response, new_cookie)
+    return response
+
+def csrf_protect(view_func=None, inject_tokens=False, shed_failures=False,
+        placeholder_tokens=False, early_check=False, lazy_cookie=False):
+    """
+    Use as @csrf_protect, or with arguments as @csrf_protect(...).
+    early_check can be True, or the identifier to check the early token
+    against - see uploads.py.
+    """
+    if view_func is None:
+        return lambda view_func: csrf_protect(view_func,
+            inject_tokens = inject_tokens,
+            shed_failures = shed_failures,
+            placeholder_tokens = placeholder_tokens,
+            early_check = early_check,
+            lazy_cookie = lazy_cookie,
+        )
+    if early_check is True:
+        early_check = 'default'
+    # Coroutine views would hand back an un-awaited coroutine here, and the
+    # cookie would never be set. The Django versions we support cannot run
+    # them anyway, so refuse them up front rather than fail silently.
+    iscoroutinefunction = getattr(inspect, 'iscoroutinefunction', None)
+    if iscoroutinefunction is not None and iscoroutinefunction(view_func):
+        raise TypeError('csrf_protect does not support async views')
     def inner(request, *args, **kwargs):
-        need_to_set_the_cookie = False
-        csrf_token = request.COOKIES.get('_csrf_cookie')
-        if not csrf_token:
-            need_to_set_the_cookie = True
-            csrf_token = sha1(str(random.random())).hexdigest()
-            request._csrf_token_to_set = csrf_token
+        if shed_failures:
+            limiter = get_failure_limiter()
+            if request.method == 'POST' and not limiter.allow(request):
+                return limiter.response(request)
+            # So csrf_utils can report rejected tokens back to it
+            request._csrf_failure_limiter = limiter
+        new_cookie = _process_request(request)
+        if early_check and request.method == 'POST':
+            response = check_before_body(request, early_check)
+            if response is not None:
+                return _process_response(request, response, new_cookie,
+                    lazy_cookie = lazy_cookie,
+                )
+        if placeholder_tokens:
+            request._csrf_placeholders = True
         response = view_func(request, *args, **kwargs)
-        if need_to_set_the_cookie:
-            response.set_cookie('_csrf_cookie', csrf_token)
-        return response
+        return _process_response(request, response, new_cookie,
+            inject_tokens = inject_tokens,
+            placeholder_tokens = placeholder_tokens,
+            lazy_cookie = lazy_cookie,
+        )
     return wraps(view_func)(inner)
@@ -0,0 +1,80 @@
+from cookies import new_cookie_secret
+from loading import load_from_setting
+
+# A token engine decides what the cookie and the tokens look like. SafeForm,
+# csrf_protect, CsrfClient and the csrf_utils functions all go through the
+# engine chosen with the CSRF_TOKEN_ENGINE setting (a dotted path to the
+# class), configured with CSRF_TOKEN_ENGINE_OPTIONS (a dictionary of keyword
+# arguments). An engine has
+#
+#   cookie_name                  - the cookie tokens are tied to
+#   get_cookie(request)          - its value for this request, or ''
+#   new_cookie()                 - a value for a new cookie
+#   set_cookie(response, value)  - sets the cookie on a response
+#   issue(request, identifiers, single_use)
+#                                - a list of tokens, one per identifier,
+#                                  all different if single_use is True
+#   check(request, tokens_and_identifiers, expire_after)
+#                                - None for each valid token, or the reason
+#                                  it was rejected - see stats.py
+#   single_use_key(token)        - what the used token store remembers a
+#                                  valid single-use token by, or None if the
+#                                  token was not issued for single use
+#
+# Placeholders, stats, single-use stores and the failure limiter are handled
+# by csrf_utils around the engine, so an engine only has to make and check
+# tokens. The default is the signed token scheme in csrf_utils.
+
+class BaseTokenEngine(object):
+    def __init__(self, cookie_name='_csrf_cookie'):
+        self.cookie_name = cookie_name
+    
+    def get_cookie(self, request):
+        # A cookie csrf_protect is about to set counts as already set
+        if hasattr(request, '_csrf_token_to_set'):
+            return request._csrf_token_to_set
+        return request.COOKIES.get(self.cookie_name, '')
+    
+    def new_cookie(self):
+        return new_cookie_secret()
+    
+    def set_cookie(self, response, value):
+        response.set_cookie(self.cookie_name, value)
+    
+    def issue(self, request, identifiers, single_use=False):
+        "Returns a list of tokens, one for each of the identifiers, in order"
+        raise NotImplementedError
+    
+    def check(self, request, tokens_and_identifiers, expire_after):
+        "Returns None for each valid token, or the reason it was rejected"
+        raise NotImplementedError
+    
+    def single_use_key(self, token):
+        "Returns what a used token is remembered by, or None to reject it"
+        return token
+
+class HmacTokenEngine(BaseTokenEngine):
+    "Tokens signed with a MAC of the secret key and the cookie"
+    
+    def issue(self, request, identifiers, single_use=False):
+        from csrf_utils import _new_csrf_tokens
+        return _new_csrf_tokens(
+            self.get_cookie(request), identifiers, single_use
+        )
+    
+    def check(self, request, tokens_and_identifiers, expire_after):
+        from csrf_utils import _check_signed_tokens
+        return _check_signed_tokens(
+            self.get_cookie(request), tokens_and_identifiers, expire_after
+        )
+    
+    def single_use_key(self, token):
+        from csrf_utils import _single_use_key
+        return _single_use_key(token)
+
+DEFAULT_ENGINE = 'django_safeform.engines.HmacTokenEngine'
+
+_engines = {}
+
+def get_token_engine():
+    return load_from_setting('CSRF_TOKEN_ENGINE', DEFAULT_ENGINE, _engines)
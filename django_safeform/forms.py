@@ -5,7 +5,10 @@ except ImportError:
 
 from django.conf import settings
 from django import forms
-from csrf_utils import new_csrf_token, validate_csrf_token
+from django.utils.encoding import StrAndUnicode
+from django.utils.safestring import mark_safe
+from csrf_utils import check_csrf_tokens, LazyCsrfToken
+from lru import LRUCache
 
 _ = lambda s: s
 
@@ -19,52 +22,209 @@ class HiddenInputNoId(forms.HiddenInput):
 
 not_set = object()
 
+# Wrapped classes, keyed on the form class and the SafeForm arguments, so
+# calling SafeForm() inside a view does not build a new class every request.
+# Bounded, as views may use an identifier per object.
+_safe_form_classes = LRUCache(max_size = 200)
+
 def SafeForm(form_class,
         identifier='default',
         invalid_message=CSRF_INVALID_MESSAGE,
         ajax_skips_check=True,
-        expire_after=not_set
+        expire_after=not_set,
+        single_use=False
     ):
+    cache_key = (form_class, identifier, invalid_message, ajax_skips_check,
+        expire_after, single_use
+    )
+    try:
+        wrapped = _safe_form_classes.get(cache_key)
+    except TypeError: # An argument is unhashable
+        wrapped = None
+    if wrapped is not None:
+        return wrapped
+    
+    check_kwargs = dict(single_use=single_use)
+    if expire_after is not not_set:
+        check_kwargs['expire_after'] = expire_after
+    
     class InnerSafeForm(form_class):
+        # Declaring the field here puts it in base_fields once, instead of
+        # constructing a new field for every form instance
+        csrf_token = forms.CharField(
+            widget = HiddenInputNoId,
+            required = False,
+        )
+        # Set by clean() to None, or why the token was rejected
+        csrf_rejection_reason = None
+        
         def __init__(self, request, data=None, files=None, *args, **kwargs):
             self.request = request
             if data is None and files is None:
-                initial_data = kwargs.get('initial', {})
-                initial_data['csrf_token'] = new_csrf_token(
-                    self.request,
-                    identifier=identifier,
+                initial_data = dict(kwargs.get('initial') or {})
+                # Only issued if the form is rendered
+                initial_data['csrf_token'] = LazyCsrfToken(
+                    self.request, identifier, single_use
                 )
                 kwargs['initial'] = initial_data
             super(InnerSafeForm, self).__init__(data, files, *args, **kwargs)
-            self.fields['csrf_token'] = forms.CharField(
-                widget = HiddenInputNoId,
-                required = False,
-            )
         
         def clean(self):
             cleaned_data = super(InnerSafeForm, self).clean()
-            token = cleaned_data.get('csrf_token', '')
-            kwargs = dict(identifier=identifier)
-            if expire_after is not not_set:
-                kwargs['expire_after'] = expire_after
-            if not token or not validate_csrf_token(
-                    token, self.request, **kwargs
-                ):
+            if ajax_skips_check and self.request.is_ajax():
+                # Not checked at all, so that Ajax requests without a token
+                # are not counted as failures
+                return cleaned_data
+            # A token checked by csrf_protect(early_check=...) may have been
+            # sent in a header instead of the form
+            token = cleaned_data.get('csrf_token') \
+                or getattr(self.request, '_csrf_early_token', '')
+            self.csrf_rejection_reason = check_csrf_tokens(
+                self.request, [(token, identifier)], **check_kwargs
+            )[0]
+            if self.csrf_rejection_reason is not None:
                 # Our form is "in flight", and we want the user to be able to 
                 # successfully resubmit it. This means we need to include a 
                 # freshly generated CSRF token in the hidden form field for 
                 # when the form is redisplayed with the validation error.
-                if not (ajax_skips_check and self.request.is_ajax()):
-                    self.data._mutable = True
-                    self.data['csrf_token'] = new_csrf_token(self.request)
-                    self.data._mutable = False
-                    raise forms.ValidationError(invalid_message)
+                self._replace_csrf_token()
+                raise forms.ValidationError(invalid_message)
+            elif single_use:
+                # The submitted token has now been used up, so the form needs
+                # a new one if it is redisplayed because of other errors
+                self._replace_csrf_token()
             return cleaned_data
+        
+        def _html_output(self, *args, **kwargs):
+            if not self.is_multipart():
+                return super(InnerSafeForm, self)._html_output(
+                    *args, **kwargs
+                )
+            # Django puts hidden fields last, but csrf_protect(early_check=...)
+            # needs the token at the start of an upload, and browsers send
+            # fields in the order they appear
+            fields = self.fields
+            self.fields = fields.copy()
+            del self.fields['csrf_token']
+            try:
+                html = super(InnerSafeForm, self)._html_output(
+                    *args, **kwargs
+                )
+            finally:
+                self.fields = fields
+            return mark_safe(u'%s%s' % (self['csrf_token'], html))
+        
+        def _replace_csrf_token(self):
+            # Only issued if the form is redisplayed
+            self.data._mutable = True
+            self.data[self.add_prefix('csrf_token')] = LazyCsrfToken(
+                self.request, identifier, single_use
+            )
+            self.data._mutable = False
     
-    return wraps(form_class, updated=())(InnerSafeForm)
+    wrapped = wraps(form_class, updated=())(InnerSafeForm)
+    try:
+        _safe_form_classes.set(cache_key, wrapped)
+    except TypeError:
+        pass
+    return wrapped
 
 class CsrfForm(forms.Form):
     def __unicode__(self):
         # Default rendering should output the error list or nothing at all
         return self.as_p()
+BaseCsrfForm = CsrfForm
 CsrfForm = SafeForm(CsrfForm)
+
+# Protecting a whole group of forms with one token, instead of one token per
+# form. The token lives in a CsrfForm that shares the group's prefix, so 
+# several groups can appear on the same page without their csrf_token fields 
+# clashing.
+
+_safe_formset_classes = LRUCache(max_size = 200)
+
+def SafeFormSet(formset_class, **kwargs):
+    """
+    Wraps a formset class so it carries a single csrf_token for all of its
+    forms. Takes the same keyword arguments as SafeForm, and changes the
+    constructor signature in the same way.
+    """
+    cache_key = (formset_class, tuple(sorted(kwargs.items())))
+    try:
+        wrapped = _safe_formset_classes.get(cache_key)
+    except TypeError: # An argument is unhashable
+        wrapped = None
+    if wrapped is not None:
+        return wrapped
+    csrf_form_class = SafeForm(BaseCsrfForm, **kwargs)
+    
+    class InnerSafeFormSet(formset_class):
+        # Formset classes are plain types, whose __doc__ cannot be assigned
+        # to after the class is made - so wraps() cannot copy it over
+        __doc__ = formset_class.__doc__
+        
+        def __init__(self, request, data=None, files=None, *args, **kwargs):
+            self.request = request
+            super(InnerSafeFormSet, self).__init__(
+                data, files, *args, **kwargs
+            )
+            self.csrf_form = csrf_form_class(
+                request, data, files, prefix=self.prefix
+            )
+        
+        def clean(self):
+            super(InnerSafeFormSet, self).clean()
+            if not self.csrf_form.is_valid():
+                raise forms.ValidationError(self.csrf_form.non_field_errors())
+        
+        def _get_csrf_token(self):
+            "The hidden csrf_token field, for use in templates"
+            return self.csrf_form['csrf_token']
+        csrf_token = property(_get_csrf_token)
+        
+        def as_table(self):
+            html = super(InnerSafeFormSet, self).as_table()
+            if self.is_multipart():
+                # First, for csrf_protect(early_check=...) - see SafeForm
+                return mark_safe(u'%s\n%s' % (self.csrf_token, html))
+            return mark_safe(u'%s\n%s' % (html, self.csrf_token))
+    
+    wrapped = InnerSafeFormSet
+    wrapped.__name__ = formset_class.__name__
+    wrapped.__module__ = formset_class.__module__
+    try:
+        _safe_formset_classes.set(cache_key, wrapped)
+    except TypeError:
+        pass
+    return wrapped
+
+class SafeFormGroup(StrAndUnicode):
+    """
+    Several ordinary forms submitted in one <form> element, protected by a
+    single token. Render the group where the token and any CSRF error
+    should go, and use is_valid() on the group instead of on each form.
+    """
+    
+    def __init__(self, request, forms, data=None, files=None, prefix=None,
+            **kwargs):
+        self.forms = list(forms)
+        self.csrf_form = SafeForm(BaseCsrfForm, **kwargs)(
+            request, data, files, prefix=prefix
+        )
+    
+    def is_valid(self):
+        valid = self.csrf_form.is_valid()
+        # Every form is validated, so they all show their errors
+        for form in self.forms:
+            valid = form.is_valid() and valid
+        return valid
+    
+    def _get_csrf_token(self):
+        return self.csrf_form['csrf_token']
+    csrf_token = property(_get_csrf_token)
+    
+    def non_field_errors(self):
+        return self.csrf_form.non_field_errors()
+    
+    def __unicode__(self):
+        return unicode(self.csrf_form)
@@ -0,0 +1,182 @@
+import binascii, hmac, re, urlparse
+from django.conf import settings
+from django.utils.encoding import smart_str
+from django.utils.hashcompat import sha_constructor as sha1
+from django.utils.html import escape
+
+# Inserts a hidden csrf_token input after every <form method="post"> tag in a 
+# response, so hand-written templates do not need to remember to include it. 
+# Streaming responses are rewritten chunk by chunk: the only thing held back 
+# between chunks is a trailing, possibly incomplete, tag - and never more than 
+# max_lookahead characters of it. Forms that post to another site are left 
+# alone, as the token would be sent along to it.
+
+form_tag_re = re.compile(r'<form\b[^>]*>', re.I)
+post_method_re = re.compile(r'''\bmethod\s*=\s*["']?post\b''', re.I)
+action_re = re.compile(
+    r'''\baction\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]*))''', re.I
+)
+
+HIDDEN_INPUT = '<input type="hidden" name="csrf_token" value="%s">'
+
+def _posts_to_origin(form_tag, origin):
+    """
+    False if the form's action is an absolute URL that is not on origin
+    ('http://example.com'), or on any site at all if origin is None
+    """
+    match = action_re.search(form_tag)
+    if not match:
+        return True
+    action = filter(None, match.groups())
+    action = action and action[0].strip() or ''
+    scheme, netloc = urlparse.urlsplit(action)[:2]
+    if not scheme and not netloc:
+        return True # Relative to this page
+    if origin is None:
+        return False
+    origin_scheme, origin_netloc = urlparse.urlsplit(origin)[:2]
+    return (scheme or origin_scheme).lower() == origin_scheme.lower() \
+        and netloc.lower() == origin_netloc.lower()
+
+def _rewrite_tags(chunks, tag_re, rewrite_tag, max_lookahead):
+    "Yields chunks with every match of tag_re replaced by rewrite_tag(match)"
+    buffer = ''
+    for chunk in chunks:
+        buffer += chunk
+        pos = 0
+        output = []
+        for match in tag_re.finditer(buffer):
+            output.append(buffer[pos:match.start()])
+            output.append(rewrite_tag(match))
+            pos = match.end()
+        # Hold back anything from an unclosed '<' onwards, as it could be the 
+        # start of a tag that continues in the next chunk
+        hold_from = buffer.rfind('<', pos)
+        if hold_from == -1 or buffer.find('>', hold_from) != -1 \
+                or len(buffer) - hold_from > max_lookahead:
+            hold_from = len(buffer)
+        output.append(buffer[pos:hold_from])
+        buffer = buffer[hold_from:]
+        output = ''.join(output)
+        if output:
+            yield output
+    if buffer:
+        yield buffer
+
+def inject_csrf_tokens(chunks, get_token, max_lookahead=4096,
+        charset='utf-8', origin=None):
+    """
+    Yields chunks, adding a hidden input after each POST <form> tag that 
+    posts back to origin. The input is encoded with charset, to match the 
+    bytes around it.
+    """
+    hidden_input = []
+    def rewrite_tag(match):
+        form_tag = match.group(0)
+        if not post_method_re.search(form_tag) \
+                or not _posts_to_origin(form_tag, origin):
+            return form_tag
+        if not hidden_input:
+            hidden_input.append(smart_str(
+                HIDDEN_INPUT % escape(get_token()), charset
+            ))
+        return form_tag + hidden_input[0]
+    return _rewrite_tags(chunks, form_tag_re, rewrite_tag, max_lookahead)
+
+def _rewrite_response(response, rewrite):
+    "Passes the response content through rewrite(chunks)"
+    if response._is_string:
+        response.content = ''.join(rewrite([response.content]))
+    else:
+        # Leave streaming responses streaming
+        response._container = rewrite(response._container)
+    if response.has_header('Content-Length'):
+        del response['Content-Length']
+    return response
+
+def inject_into_response(response, get_token, origin=None):
+    if 'html' not in response.get('Content-Type', '') \
+            or response.has_header('Content-Encoding'):
+        return response
+    return _rewrite_response(response,
+        lambda chunks: inject_csrf_tokens(chunks, get_token,
+            charset = response._charset,
+            origin = origin,
+        )
+    )
+
+# Placeholder tokens make pages with forms cacheable. While a view is running
+# under csrf_protect(placeholder_tokens=True), csrf_utils hands out a 
+# placeholder for each identifier instead of a token, and the response - 
+# which may come straight from a cache - has the placeholders swapped for 
+# real tokens on its way out. The identifier is hex encoded so that the 
+# placeholder survives HTML escaping unchanged. Placeholders for single-use 
+# tokens are marked "once_", and each gets a token of its own.
+#
+# A placeholder anywhere else on the page - in a comment, or a URL someone 
+# put in their profile - must not be swapped, or it would hand the visitor's 
+# token to whoever wrote it. So placeholders are only swapped inside the 
+# value of a csrf_token <input>, and each carries a MAC keyed on SECRET_KEY, 
+# so one cannot be made up without it. The MAC does not change between 
+# processes, so a page cached by one can be served by another.
+
+PLACEHOLDER_START = '__csrf_placeholder_'
+placeholder_re = re.compile(
+    r'__csrf_placeholder_(once_)?([0-9a-f]*)_([0-9a-f]{16})__'
+)
+input_tag_re = re.compile(r'<input\b[^>]*>', re.I)
+# csrf_token, or prefix-csrf_token for a form with a prefix
+csrf_name_re = re.compile(
+    r'''\bname\s*=\s*["']?(?:[^"'\s>]*-)?csrf_token(?:["'\s/>]|$)''', re.I
+)
+
+def _placeholder_mac(body):
+    return hmac.new(smart_str(settings.SECRET_KEY),
+        'csrf-placeholder:' + body, sha1
+    ).hexdigest()[:16]
+
+def placeholder(identifier, single_use=False):
+    body = binascii.hexlify(smart_str(identifier))
+    if single_use:
+        body = 'once_' + body
+    return '%s%s_%s__' % (PLACEHOLDER_START, body, _placeholder_mac(body))
+
+def substitute_placeholders(chunks, get_token, max_lookahead=4096,
+        charset='utf-8'):
+    """
+    Yields chunks with each placeholder in a csrf_token input replaced by
+    get_token(identifier, single_use), encoded with charset
+    """
+    from csrf_utils import constant_time_compare
+    tokens = {}
+    def replace(match):
+        once, hex_identifier, mac = match.groups()
+        body = (once or '') + hex_identifier
+        # The regex means str() is safe, and compare_digest will not compare
+        # unicode with str
+        if not constant_time_compare(str(mac), _placeholder_mac(body)):
+            return match.group(0)
+        identifier = binascii.unhexlify(hex_identifier)
+        if once:
+            # Every single-use token must be different
+            return smart_str(get_token(identifier, True), charset)
+        if hex_identifier not in tokens:
+            tokens[hex_identifier] = smart_str(
+                get_token(identifier, False), charset
+            )
+        return tokens[hex_identifier]
+    def rewrite_tag(match):
+        input_tag = match.group(0)
+        if not csrf_name_re.search(input_tag):
+            return input_tag
+        return placeholder_re.sub(replace, input_tag)
+    return _rewrite_tags(chunks, input_tag_re, rewrite_tag, max_lookahead)
+
+def substitute_in_response(response, get_token):
+    if response.has_header('Content-Encoding'):
+        return response
+    return _rewrite_response(response,
+        lambda chunks: substitute_placeholders(chunks, get_token,
+            charset = response._charset,
+        )
+    )
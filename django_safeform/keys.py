@@ -0,0 +1,91 @@
+import os
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.encoding import smart_str
+from django.utils.hashcompat import sha_constructor as sha1
+from clock import get_clock
+
+# Tokens are signed with the first of the active secret keys, and carry a 
+# short key id so validation can go straight to the key that signed them. 
+# Keys come from, in order of preference:
+#
+#   CSRF_SECRET_KEYS_FILE - a file with one key per line, re-read when it 
+#                           changes so keys can be rotated without a restart
+#   CSRF_SECRET_KEYS      - a list of keys in settings.py
+#   SECRET_KEY            - the only key, if neither of the above are set
+
+def key_id(secret_key):
+    "Returns the short id embedded in tokens signed with secret_key"
+    return sha1('django_safeform.key_id:' + smart_str(secret_key)
+        ).hexdigest()[:4]
+
+class KeyRing(object):
+    def __init__(self, secret_keys):
+        if not secret_keys:
+            raise ImproperlyConfigured('No CSRF secret keys are configured')
+        self.secret_keys = tuple(secret_keys)
+        self.keys = {}
+        for secret_key in self.secret_keys:
+            kid = key_id(secret_key)
+            if self.keys.get(kid, secret_key) != secret_key:
+                raise ImproperlyConfigured(
+                    'Two CSRF secret keys share the key id %s' % kid
+                )
+            self.keys[kid] = secret_key
+        self.signing_key = self.secret_keys[0]
+        self.signing_kid = key_id(self.signing_key)
+    
+    def get(self, kid):
+        "Returns the secret key for kid, or None if it is not active"
+        return self.keys.get(kid)
+
+_keyrings = {}
+
+def _keyring_for(secret_keys):
+    keyring = _keyrings.get(secret_keys)
+    if keyring is None:
+        if len(_keyrings) > 10:
+            _keyrings.clear()
+        keyring = _keyrings[secret_keys] = KeyRing(secret_keys)
+    return keyring
+
+def read_keys_file(path):
+    "One key per line - blank lines and lines starting with # are ignored"
+    fp = open(path)
+    try:
+        lines = [line.strip() for line in fp]
+    finally:
+        fp.close()
+    return tuple([line for line in lines if line and not line.startswith('#')])
+
+# path => [mtime, time last checked, KeyRing]
+_keys_files = {}
+
+def _keyring_from_file(path):
+    now = get_clock().now()
+    state = _keys_files.get(path)
+    interval = getattr(settings, 'CSRF_SECRET_KEYS_FILE_CHECK_INTERVAL', 5)
+    if state is not None and now < state[1] + interval:
+        return state[2]
+    try:
+        mtime = os.stat(path).st_mtime
+        if state is None or mtime != state[0]:
+            state = [mtime, now, _keyring_for(read_keys_file(path))]
+    except (EnvironmentError, ImproperlyConfigured):
+        # A missing or half-written file should not take the site down if 
+        # we already have some keys, so keep using those and check again 
+        # after the next interval
+        if state is None:
+            raise
+    state[1] = now
+    _keys_files[path] = state
+    return state[2]
+
+def get_keyring():
+    path = getattr(settings, 'CSRF_SECRET_KEYS_FILE', None)
+    if path:
+        return _keyring_from_file(path)
+    secret_keys = getattr(settings, 'CSRF_SECRET_KEYS', None)
+    if not secret_keys:
+        secret_keys = (settings.SECRET_KEY,)
+    return _keyring_for(tuple(secret_keys))
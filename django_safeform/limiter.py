@@ -0,0 +1,95 @@
+import math, threading
+from django.conf import settings
+from django.http import HttpResponseForbidden
+from clock import get_clock
+from engines import get_token_engine
+from lru import LRUCache
+
+# Load shedding for clients that keep submitting bad tokens. Each client has
+# a token bucket holding up to `capacity` failures, which refills at
+# `refill_rate` failures a second. Every rejected CSRF token takes one out,
+# and once the bucket is empty csrf_protect(shed_failures=True) answers that
+# client's POSTs with a short 403 without calling the view, until the bucket
+# has refilled enough. Buckets live in an LRU cache, so a flood of new
+# clients pushes out the least recently seen ones instead of using up memory.
+#
+# Clients are told apart by their CSRF cookie, or by REMOTE_ADDR if they
+# have no cookie or key_on is 'address'. Clients can drop their cookie at
+# will, so use 'address' if that is a concern and your users do not share
+# addresses behind proxies.
+
+TOKENS, UPDATED = 0, 1
+
+class FailureLimiter(object):
+    def __init__(self, capacity=10, refill_rate=0.1, max_size=10000,
+            key_on='cookie'):
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self.key_on = key_on
+        self.buckets = LRUCache(max_size)
+        self._lock = threading.Lock()
+    
+    def key(self, request):
+        if self.key_on == 'cookie':
+            cookie = request.COOKIES.get(get_token_engine().cookie_name)
+            if cookie:
+                return 'cookie:' + cookie
+        return 'address:' + request.META.get('REMOTE_ADDR', '')
+    
+    def _refill(self, bucket, now):
+        # Caller must hold the lock
+        bucket[TOKENS] = min(self.capacity,
+            bucket[TOKENS] + (now - bucket[UPDATED]) * self.refill_rate
+        )
+        bucket[UPDATED] = now
+    
+    def allow(self, request):
+        "Returns False if the client has run out of failures"
+        bucket = self.buckets.get(self.key(request))
+        if bucket is None:
+            return True
+        self._lock.acquire()
+        try:
+            self._refill(bucket, get_clock().now())
+            return bucket[TOKENS] >= 1
+        finally:
+            self._lock.release()
+    
+    def record_failure(self, request):
+        key = self.key(request)
+        now = get_clock().now()
+        self._lock.acquire()
+        try:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = [self.capacity, now]
+                self.buckets.set(key, bucket)
+            self._refill(bucket, now)
+            bucket[TOKENS] = max(bucket[TOKENS] - 1, 0)
+        finally:
+            self._lock.release()
+    
+    def retry_after(self, request):
+        "Whole seconds until the client may try again"
+        bucket = self.buckets.get(self.key(request))
+        if bucket is None or bucket[TOKENS] >= 1 or not self.refill_rate:
+            return 0
+        return int(math.ceil((1 - bucket[TOKENS]) / self.refill_rate))
+    
+    def response(self, request):
+        response = HttpResponseForbidden(
+            'Too many failed form submissions - please try again later'
+        )
+        response['Retry-After'] = str(self.retry_after(request))
+        return response
+
+_limiters = {}
+
+def get_failure_limiter():
+    "Configured with the CSRF_FAILURE_LIMITER_OPTIONS setting"
+    options = getattr(settings, 'CSRF_FAILURE_LIMITER_OPTIONS', {})
+    cache_key = repr(sorted(options.items()))
+    limiter = _limiters.get(cache_key)
+    if limiter is None:
+        limiter = _limiters[cache_key] = FailureLimiter(**options)
+    return limiter
@@ -0,0 +1,27 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.importlib import import_module
+
+# Engines, stats sinks and used token stores are all chosen with a setting
+# holding a dotted path to a class, plus a <setting>_OPTIONS dictionary of
+# keyword arguments for it. One instance is made for each path and set of
+# options, so tests can change the settings and get a fresh instance.
+
+def load_from_setting(name, default, cache):
+    """
+    Returns the instance configured by the setting called name, made from
+    the class at the dotted path default if the setting is missing. cache
+    is a dictionary that instances are kept in.
+    """
+    path = getattr(settings, name, default)
+    options = getattr(settings, name + '_OPTIONS', {})
+    cache_key = (path, repr(sorted(options.items())))
+    instance = cache.get(cache_key)
+    if instance is None:
+        module_name, class_name = path.rsplit('.', 1)
+        try:
+            cls = getattr(import_module(module_name), class_name)
+        except (ImportError, AttributeError):
+            raise ImproperlyConfigured('Could not load %s %s' % (name, path))
+        instance = cache[cache_key] = cls(**options)
+    return instance
@@ -0,0 +1,148 @@
+import math, threading
+from timeit import default_timer
+from django.conf import settings
+from django.core.urlresolvers import clear_url_caches
+from django_safeform.forms import CSRF_INVALID_MESSAGE
+from django_safeform.test_utils import CsrfClient, extract_input_tags
+
+# A load generator for CSRF protected views, run in-process through the test
+# client - no server, network or external tool needed. Each simulated user
+# has its own CsrfClient, and so its own cookie jar, and repeatedly GETs a
+# form and POSTs it back with the csrf_token from the page. Run it with
+# "./manage.py csrf_loadtest" or call run_load() directly.
+
+def is_rejected(response):
+    "The default test for a response that failed the CSRF check"
+    return response.status_code == 403 \
+        or CSRF_INVALID_MESSAGE in response.content
+
+class LoadResult(object):
+    def __init__(self, latencies, rejections, errors, elapsed):
+        self.latencies = sorted(latencies)
+        self.rejections = rejections
+        self.errors = errors
+        self.elapsed = elapsed
+    
+    def flows(self):
+        return len(self.latencies) + self.errors
+    
+    def throughput(self):
+        "Completed GET and POST flows per second"
+        return len(self.latencies) / max(self.elapsed, 1e-9)
+    
+    def percentile(self, percent):
+        "Flow latency in seconds, by the nearest rank method"
+        if not self.latencies:
+            return None
+        rank = int(math.ceil(percent / 100.0 * len(self.latencies))) - 1
+        return self.latencies[max(0, min(rank, len(self.latencies) - 1))]
+    
+    def rejection_rate(self):
+        if not self.latencies:
+            return 0.0
+        return float(self.rejections) / len(self.latencies)
+    
+    def summary(self):
+        lines = [
+            'Flows:       %d in %.2f seconds (%d errors)' % (
+                self.flows(), self.elapsed, self.errors
+            ),
+            'Throughput:  %.1f flows/sec' % self.throughput(),
+            'Rejected:    %.2f%%' % (100 * self.rejection_rate()),
+        ]
+        for percent in (50, 90, 99):
+            latency = self.percentile(percent)
+            if latency is not None:
+                lines.append('Latency p%d: %8.2f ms' % (
+                    percent, latency * 1000
+                ))
+        return '\n'.join(lines)
+
+def _run_flows(path, data, flows, get_first, rejected, out):
+    "Runs flows as one user, appending (latencies, rejections, errors) to out"
+    client = CsrfClient()
+    latencies = []
+    rejections = errors = 0
+    for i in range(flows):
+        start = default_timer()
+        try:
+            post_data = dict(data)
+            if get_first:
+                response = client.get(path)
+                token = extract_input_tags(response.content).get('csrf_token')
+                if token is not None:
+                    post_data['csrf_token'] = token
+            # Without a token from the page, CsrfClient forges one from
+            # its cookie
+            response = client.post(path, post_data)
+        except Exception:
+            errors += 1
+            continue
+        latencies.append(default_timer() - start)
+        if rejected(response):
+            rejections += 1
+    out.append((latencies, rejections, errors))
+
+def _run_threads(path, data, flows, threads, get_first, rejected):
+    out = []
+    workers = [
+        threading.Thread(target=_run_flows, args=(
+            path, data, flows // threads + (i < flows % threads),
+            get_first, rejected, out,
+        ))
+        for i in range(threads)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return out
+
+def _process_worker(args):
+    return _run_threads(*args)
+
+def run_load(path, data=None, flows=1000, threads=10, processes=1,
+        get_first=True, urlconf=None, rejected=is_rejected):
+    """
+    Runs flows GET/POST flows against path, spread over threads threads in
+    each of processes processes, and returns a LoadResult. urlconf replaces
+    ROOT_URLCONF for the duration. With more than one process, rejected must
+    be a module level function so that it can be pickled.
+    """
+    data = data or {}
+    orig_urlconf = settings.ROOT_URLCONF
+    if urlconf is not None:
+        settings.ROOT_URLCONF = urlconf
+        clear_url_caches()
+    try:
+        start = default_timer()
+        if processes > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(processes)
+            try:
+                out = []
+                for process_out in pool.map(_process_worker, [
+                    (path, data, flows // processes + (i < flows % processes),
+                        threads, get_first, rejected)
+                    for i in range(processes)
+                ]):
+                    out.extend(process_out)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            out = _run_threads(
+                path, data, flows, threads, get_first, rejected
+            )
+        elapsed = default_timer() - start
+    finally:
+        if urlconf is not None:
+            settings.ROOT_URLCONF = orig_urlconf
+            clear_url_caches()
+    latencies = []
+    rejections = errors = 0
+    for worker_latencies, worker_rejections, worker_errors in out:
+        latencies.extend(worker_latencies)
+        rejections += worker_rejections
+        errors += worker_errors
+    return LoadResult(latencies, rejections, errors, elapsed)
@@ -0,0 +1,109 @@
+import threading, time
+
+# Positions within a linked list node - nodes are plain lists, which keeps
+# the per-entry overhead down compared with instances.
+PREV, NEXT, KEY, VALUE, EXPIRES = 0, 1, 2, 3, 4
+
+class LRUCache(object):
+    "A bounded, thread-safe least-recently-used cache with optional TTL"
+    
+    def __init__(self, max_size=1000, ttl=None, timer=time.time):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.timer = timer
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._clear()
+    
+    def _clear(self):
+        self._map = {}
+        # Circular doubly linked list, most recently used entry at root[PREV]
+        self._root = root = []
+        root[:] = [root, root, None, None, None]
+    
+    def _unlink(self, node):
+        node[PREV][NEXT] = node[NEXT]
+        node[NEXT][PREV] = node[PREV]
+    
+    def _append(self, node):
+        root = self._root
+        last = root[PREV]
+        node[PREV], node[NEXT] = last, root
+        last[NEXT] = root[PREV] = node
+    
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            node = self._map.get(key)
+            if node is not None and node[EXPIRES] is not None \
+                    and node[EXPIRES] < self.timer():
+                self._unlink(node)
+                del self._map[key]
+                node = None
+            if node is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._unlink(node)
+            self._append(node)
+            return node[VALUE]
+        finally:
+            self._lock.release()
+    
+    def set(self, key, value, ttl=None):
+        self._lock.acquire()
+        try:
+            self._set(key, value, ttl)
+        finally:
+            self._lock.release()
+    
+    def add(self, key, value, ttl=None):
+        "Like set(), but only if key is not present - returns True if added"
+        self._lock.acquire()
+        try:
+            node = self._map.get(key)
+            if node is not None and (
+                    node[EXPIRES] is None or node[EXPIRES] >= self.timer()):
+                return False
+            self._set(key, value, ttl)
+            return True
+        finally:
+            self._lock.release()
+    
+    def _set(self, key, value, ttl):
+        # Caller must hold the lock
+        if ttl is None:
+            ttl = self.ttl
+        expires = None
+        if ttl is not None:
+            now = self.timer()
+            expires = now + ttl
+            # Entries mostly share a TTL, so expired ones collect at the
+            # least recently used end of the list - drop them as we go
+            oldest = self._root[NEXT]
+            while oldest[EXPIRES] is not None and oldest[EXPIRES] < now:
+                self._unlink(oldest)
+                del self._map[oldest[KEY]]
+                oldest = self._root[NEXT]
+        node = self._map.get(key)
+        if node is not None:
+            self._unlink(node)
+        node = [None, None, key, value, expires]
+        self._append(node)
+        self._map[key] = node
+        while len(self._map) > self.max_size:
+            oldest = self._root[NEXT]
+            self._unlink(oldest)
+            del self._map[oldest[KEY]]
+    
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._clear()
+            self.hits = self.misses = 0
+        finally:
+            self._lock.release()
+    
+    def __len__(self):
+        return len(self._map)
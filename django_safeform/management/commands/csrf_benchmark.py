@@ -0,0 +1,54 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django_safeform import benchmarks
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--save', dest='save',
+            help='Save the results as a baseline to this file'),
+        make_option('--compare', dest='compare',
+            help='Compare the results against the baseline in this file'),
+        make_option('--threshold', dest='threshold', type='float',
+            default=10,
+            help='Percentage slowdown counted as a regression (default 10)'),
+        make_option('--engine', dest='engine',
+            help='Dotted path to a token engine to use instead of '
+                'CSRF_TOKEN_ENGINE'),
+        make_option('--min-time', dest='min_time', type='float', default=0.2,
+            help='Minimum seconds to time each benchmark for'),
+    )
+    help = 'Measures the speed of django_safeform token, form and ' \
+        'decorator hot paths.'
+    args = '[benchmark ...]'
+    
+    def handle(self, *names, **options):
+        known = [name for name, setup in benchmarks.registry]
+        for name in names:
+            if name not in known:
+                raise CommandError('Unknown benchmark: %s' % name)
+        baseline = None
+        if options.get('compare'):
+            baseline = benchmarks.load_baseline(options['compare'])
+        results = benchmarks.run_benchmarks(names,
+            min_time = options.get('min_time', 0.2),
+            engine = options.get('engine'),
+        )
+        print benchmarks.format_results(results, baseline)
+        if options.get('save'):
+            benchmarks.save_baseline(results, options['save'])
+        errors = []
+        problems = benchmarks.find_scaling_problems(results)
+        if problems:
+            errors.append('Does not scale linearly: %s' % ', '.join(
+                ['%s -> %s (%.1fx slower)' % p for p in problems]
+            ))
+        if baseline is not None:
+            regressions = benchmarks.find_regressions(
+                results, baseline, options.get('threshold', 10)
+            )
+            if regressions:
+                errors.append('Slower than the baseline: %s' % ', '.join(
+                    ['%s (%.1f -> %.1f ops/sec)' % r for r in regressions]
+                ))
+        if errors:
+            raise CommandError('\n'.join(errors))
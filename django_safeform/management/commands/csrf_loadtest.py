@@ -0,0 +1,40 @@
+from optparse import make_option
+from django.core.management.base import BaseCommand, CommandError
+from django_safeform import loadtest
+
+class Command(BaseCommand):
+    option_list = BaseCommand.option_list + (
+        make_option('--flows', dest='flows', type='int', default=1000,
+            help='Number of GET/POST flows to run (default 1000)'),
+        make_option('--threads', dest='threads', type='int', default=10,
+            help='Simulated users per process (default 10)'),
+        make_option('--processes', dest='processes', type='int', default=1,
+            help='Worker processes (default 1)'),
+        make_option('--urlconf', dest='urlconf',
+            help='URLconf to use instead of ROOT_URLCONF'),
+        make_option('--no-get', dest='get_first', action='store_false',
+            default=True,
+            help='POST straight away, with a token forged from the cookie'),
+    )
+    help = 'Runs GET then POST form flows against a CSRF protected URL ' \
+        'from many simulated users, and reports throughput, latency and ' \
+        'the CSRF rejection rate.'
+    args = '<path> [name=value ...]'
+    
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError('Enter the path of the form to load test')
+        data = {}
+        for pair in args[1:]:
+            if '=' not in pair:
+                raise CommandError('Form data must be name=value: %s' % pair)
+            name, value = pair.split('=', 1)
+            data[name] = value
+        result = loadtest.run_load(args[0], data,
+            flows = options.get('flows', 1000),
+            threads = options.get('threads', 10),
+            processes = options.get('processes', 1),
+            get_first = options.get('get_first', True),
+            urlconf = options.get('urlconf'),
+        )
+        print result.summary()
@@ -0,0 +1,140 @@
+import bisect, re, socket, threading
+from django.conf import settings
+from django.utils.encoding import smart_str
+from loading import load_from_setting
+
+# csrf_utils reports what it does to a stats sink, chosen with the
+# CSRF_STATS setting (a dotted path to the class) and configured with
+# CSRF_STATS_OPTIONS (a dictionary of keyword arguments). A sink has two
+# methods, with statsd-style dotted names:
+#
+#   incr(name, count=1)   - adds to a counter
+#   timing(name, seconds) - records how long something took
+#
+# The counters are
+#
+#   issued, issued.<identifier>
+#   accepted, accepted.<identifier>
+#   rejected.<reason>, rejected.<reason>.<identifier>
+#
+# where reason is one of REJECTION_REASONS, and the timings are "issue" and
+# "validate", once per call to new_csrf_tokens or validate_csrf_tokens. The
+# per-identifier counters are only kept if CSRF_STATS_PER_IDENTIFIER is True,
+# as sites with an identifier per object would otherwise have a counter per
+# object. The default sink does nothing, and csrf_utils skips the timing
+# entirely when it is in use.
+
+REJECTION_REASONS = (
+    'missing',          # No token was submitted
+    'malformed',        # Not something we could have issued
+    'unknown_key',      # Signed with a key that is no longer active
+    'bad_signature',    # Tampered with, or issued for another cookie
+    'wrong_identifier', # Issued for a different form
+    'expired',          # Older than expire_after
+    'already_used',     # A single-use token submitted a second time
+)
+
+# Anything other than these could be misread by statsd (":", "|" and "@"
+# separate the fields of a packet) or start a new level of the name (".")
+unsafe_name_re = re.compile(r'[^A-Za-z0-9_-]')
+
+def metric_name(*parts):
+    "Joins parts with dots, replacing unsafe characters with underscores"
+    return '.'.join([
+        unsafe_name_re.sub('_', smart_str(part)) for part in parts
+    ])
+
+def per_identifier():
+    return getattr(settings, 'CSRF_STATS_PER_IDENTIFIER', False)
+
+class NullStats(object):
+    "Discards everything"
+    enabled = False
+    
+    def incr(self, name, count=1):
+        pass
+    
+    def timing(self, name, seconds):
+        pass
+
+# Histogram bucket upper bounds in seconds, from 10 microseconds to a second
+TIMING_BUCKETS = (
+    0.00001, 0.00002, 0.00005, 0.0001, 0.0002, 0.0005,
+    0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0,
+)
+
+class MemoryStats(object):
+    """
+    Keeps counters and timing histograms in this process. Each worker
+    process has its own - use StatsdStats to add them up across processes.
+    At most max_names counters are kept - new names after that are counted
+    under "dropped" instead.
+    """
+    enabled = True
+    
+    def __init__(self, buckets=TIMING_BUCKETS, max_names=1000):
+        self.buckets = tuple(buckets)
+        self.max_names = max_names
+        self._lock = threading.Lock()
+        self.reset()
+    
+    def reset(self):
+        self.counters = {}
+        # name => list of counts, one per bucket plus one for anything slower
+        self.histograms = {}
+    
+    def incr(self, name, count=1):
+        self._lock.acquire()
+        try:
+            if name not in self.counters \
+                    and len(self.counters) >= self.max_names:
+                name = 'dropped'
+            self.counters[name] = self.counters.get(name, 0) + count
+        finally:
+            self._lock.release()
+    
+    def timing(self, name, seconds):
+        i = bisect.bisect_left(self.buckets, seconds)
+        self._lock.acquire()
+        try:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = [0] * (
+                    len(self.buckets) + 1
+                )
+            histogram[i] += 1
+        finally:
+            self._lock.release()
+
+class StatsdStats(object):
+    """
+    Sends everything to a statsd server over UDP, which adds up the numbers
+    from every process. Sending never blocks, and packets that cannot be
+    sent are dropped.
+    """
+    enabled = True
+    
+    def __init__(self, host='localhost', port=8125, prefix='django_safeform'):
+        self.address = (host, port)
+        self.prefix = prefix
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.setblocking(0)
+    
+    def _send(self, data):
+        try:
+            self._socket.sendto('%s.%s' % (self.prefix, data), self.address)
+        except socket.error:
+            pass
+    
+    def incr(self, name, count=1):
+        self._send('%s:%d|c' % (name, count))
+    
+    def timing(self, name, seconds):
+        self._send('%s:%.3f|ms' % (name, seconds * 1000))
+
+_sinks = {}
+
+def get_stats():
+    return load_from_setting(
+        'CSRF_STATS', 'django_safeform.stats.NullStats', _sinks
+    )
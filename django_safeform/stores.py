@@ -0,0 +1,103 @@
+import threading
+from clock import get_clock
+from loading import load_from_setting
+from lru import LRUCache
+
+# Stores remember which tokens have been used, for single-use tokens. A store 
+# has one method, add(token, ttl), which records the token for ttl seconds 
+# and returns False if it was already recorded. The store is chosen with the 
+# CSRF_USED_TOKEN_STORE setting (a dotted path to the class) and configured 
+# with CSRF_USED_TOKEN_STORE_OPTIONS (a dictionary of keyword arguments).
+
+DEFAULT_TTL = 24 * 60 * 60
+
+def _now():
+    return get_clock().now()
+
+class BaseTokenStore(object):
+    def __init__(self, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+    
+    def add(self, token, ttl=None):
+        "Records token as used - returns False if it had already been used"
+        raise NotImplementedError
+
+class MemoryTokenStore(BaseTokenStore):
+    """
+    Keeps used tokens in this process, in a number of independently locked 
+    LRU caches so that threads rarely wait for each other. Holds at most 
+    max_size tokens - make sure that is more than you expect to see used 
+    within the TTL, or the oldest will be forgotten early.
+    """
+    
+    def __init__(self, ttl=DEFAULT_TTL, max_size=100000, stripes=16):
+        super(MemoryTokenStore, self).__init__(ttl)
+        self._stripes = [
+            LRUCache(max_size // stripes, ttl, timer=_now)
+            for i in range(stripes)
+        ]
+    
+    def add(self, token, ttl=None):
+        stripe = self._stripes[hash(token) % len(self._stripes)]
+        return stripe.add(token, True, ttl)
+    
+    def __len__(self):
+        return sum([len(stripe) for stripe in self._stripes])
+
+class SQLiteTokenStore(BaseTokenStore):
+    "Keeps used tokens in an SQLite file, shared by processes on one machine"
+    
+    # Expired rows are deleted once every purge_every additions
+    purge_every = 1000
+    
+    def __init__(self, path, ttl=DEFAULT_TTL, timeout=5.0):
+        super(SQLiteTokenStore, self).__init__(ttl)
+        self.path = path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._adds = 0
+        self._connection().execute(
+            'CREATE TABLE IF NOT EXISTS used_tokens ('
+            'token TEXT PRIMARY KEY, expires INTEGER NOT NULL)'
+        )
+    
+    def _connection(self):
+        # SQLite connections may not be shared between threads
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            import sqlite3
+            connection = sqlite3.connect(
+                self.path, timeout=self.timeout, isolation_level=None
+            )
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+    
+    def add(self, token, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        now = _now()
+        connection = self._connection()
+        self._adds += 1
+        if self._adds % self.purge_every == 0:
+            connection.execute(
+                'DELETE FROM used_tokens WHERE expires < ?', (now,)
+            )
+        else:
+            connection.execute(
+                'DELETE FROM used_tokens WHERE token = ? AND expires < ?',
+                (token, now)
+            )
+        cursor = connection.execute(
+            'INSERT OR IGNORE INTO used_tokens (token, expires) VALUES (?, ?)',
+            (token, now + ttl)
+        )
+        return cursor.rowcount == 1
+
+_stores = {}
+
+def get_used_token_store():
+    return load_from_setting('CSRF_USED_TOKEN_STORE',
+        'django_safeform.stores.MemoryTokenStore', _stores
+    )
@@ -2,18 +2,22 @@ try:
     from functools import wraps
 except ImportError:
     from django.utils.functional import wraps  # Python 2.3, 2.4 fallback.
-import datetime, re
+import calendar
+from HTMLParser import HTMLParser
 
 from django.http import SimpleCookie
 from django.test.client import Client, MULTIPART_CONTENT
 from django.test.testcases import TestCase
 from django_safeform import csrf_utils
+from django_safeform.clock import FixedClock, get_clock, set_clock
+from django_safeform.engines import get_token_engine
 
 class CsrfClient(Client):
     class _CookieRequest:
         def __init__(self, cookies):
-            if not '_csrf_cookie' in cookies:
-                cookies['_csrf_cookie'] = 'csrf-cookie'
+            cookie_name = get_token_engine().cookie_name
+            if not cookie_name in cookies:
+                cookies[cookie_name] = 'csrf-cookie'
             self.COOKIES = dict([
                 (key, cookies[key].value) for key in cookies
             ])
@@ -21,7 +25,7 @@ class CsrfClient(Client):
     def post(self, path, data={}, content_type=MULTIPART_CONTENT,
         follow=False, csrf='default', **extra):
         "Requests a response from the server using POST, auto-includes CSRF "
-        "token unless csrf=False or the _csrf_cookie has not yet been set."
+        "token unless csrf=False or the CSRF cookie has not yet been set."
         if csrf and content_type == MULTIPART_CONTENT \
                 and not data.has_key('csrf_token'):
             data['csrf_token'] = csrf_utils.new_csrf_token(
@@ -41,18 +45,35 @@ class CsrfTestCase(TestCase):
 #     <input type="hidden" name="csrf_token" value="...">
 # tags so you can POST a correct value.
 
-input_re = re.compile('<input(.*?)>')
-attrib_re = re.compile(r'(\w+)=(["\'])(.*?)(\2)')
+class InputTagParser(HTMLParser):
+    """
+    Collects the attributes of every input tag. HTML can be fed in chunks of 
+    any size - a tag split between chunks is held back until it is complete.
+    """
+    
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.input_tags = []
+    
+    def handle_starttag(self, tag, attrs):
+        if tag == 'input':
+            # Attributes without a value, like "checked", are empty strings
+            self.input_tags.append(dict([
+                (name, value or '') for name, value in attrs
+            ]))
 
 def extract_input_tag_attrs(html):
-    "Returns a list of HTML attribute dictionaries for all inputs found"
-    input_tags = []
-    for input in input_re.findall(html):
-        pairs = []
-        for bits in attrib_re.findall(input):
-            pairs.append((bits[0], bits[2]))
-        input_tags.append(dict(pairs))
-    return input_tags
+    """
+    Returns a list of HTML attribute dictionaries for all inputs found. html
+    can be a string, or an iterable of strings such as a streaming response.
+    """
+    if isinstance(html, basestring):
+        html = [html]
+    parser = InputTagParser()
+    for chunk in html:
+        parser.feed(chunk)
+    parser.close()
+    return parser.input_tags
 
 def extract_input_tags(html):
     "Returns a dictionary of name => value for all inputs found"
@@ -63,20 +84,21 @@ def extract_input_tags(html):
         if d.has_key('name')
     ])
 
-# Decorator for temporarily monkey-patching datetime.utcnow
+# Decorators for temporarily fixing the time seen by csrf_utils. These only
+# affect the current thread.
 
-def fake_utcnow(fake):
+def fake_clock(epoch_time):
     def outer(fn):
         def inner(*args, **kwargs):
-            class _Object: pass
-            orig_datetime = datetime.datetime
-            fake_datetime = _Object()
-            fake_datetime.utcnow = lambda: fake
-            datetime.datetime = fake_datetime
+            orig_clock = get_clock()
+            set_clock(FixedClock(epoch_time))
             try:
-                ret_value = fn(*args, **kwargs)
-            finally: # or exception raised by fn() will not revert monkeypatch
-                datetime.datetime = orig_datetime
-            return ret_value
+                return fn(*args, **kwargs)
+            finally: # or exception raised by fn() will not restore the clock
+                set_clock(orig_clock)
         return wraps(fn)(inner)
     return outer
+
+def fake_utcnow(fake):
+    "Like fake_clock, but takes a UTC datetime"
+    return fake_clock(calendar.timegm(fake.utctimetuple()))
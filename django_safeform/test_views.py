@@ -3,6 +3,7 @@ from django import forms
 from django.forms.formsets import formset_factory
 from django.http import HttpResponse, HttpResponseRedirect
 from django_safeform import SafeForm, csrf_protect, csrf_utils, CsrfForm
+from django_safeform import SafeFormSet, SafeFormGroup
 
 class BasicForm(forms.Form):
     name = forms.CharField(max_length = 100)
@@ -57,6 +58,31 @@ def hand_rolled_view(request):
         </form>
         """ % csrf_utils.new_csrf_token(request))
 
+@csrf_protect(inject_tokens=True)
+def injected_view(request):
+    if request.method == 'POST':
+        if csrf_utils.validate_csrf_token(
+                request.POST.get('csrf_token', ''), request):
+            return HttpResponse('OK')
+        return HttpResponse('Invalid CSRF token')
+    return HttpResponse("""
+        <form action="." method="post">
+        <input type="text" name="name">
+        </form>
+        <form action="/search/" method="get"></form>
+        <form action="http://elsewhere.example.com/" method="post"></form>
+        """)
+
+@csrf_protect(inject_tokens=True)
+def injected_non_ascii_view(request):
+    return HttpResponse(u'<p>Caf\xe9</p><form action="." method="post"></form>')
+
+@csrf_protect(inject_tokens=True)
+def injected_streaming_view(request):
+    html = '<p>Report</p><form action="." method="post"><p>' + 'x' * 10000
+    # Chunks that split the form tag part way through
+    return HttpResponse(iter([html[:20], html[20:30], html[30:]]))
+
 @csrf_protect
 def two_forms_view(request):
     form1 = SafeBasicForm(request)
@@ -148,6 +174,124 @@ def expire_after_60_seconds_form_view(request):
             return HttpResponse('Valid: %s' % form.cleaned_data['name'])
     return HttpResponse(form.as_p())
 
+@csrf_protect
+def single_use_form_view(request):
+    Form = SafeForm(BasicForm, single_use=True)
+    form = Form(request)
+    if request.method == 'POST':
+        form = Form(request, request.POST)
+        if form.is_valid():
+            return HttpResponse('Valid: %s' % form.cleaned_data['name'])
+    return HttpResponse(form.as_p())
+
+@csrf_protect(shed_failures=True)
+def shed_failures_view(request):
+    form = SafeBasicForm(request)
+    if request.method == 'POST':
+        form = SafeBasicForm(request, request.POST)
+        if form.is_valid():
+            return HttpResponse('Valid: %s' % form.cleaned_data['name'])
+    return HttpResponse(form.as_p())
+
+# Stands in for the per-view or template fragment cache
+placeholder_page_cache = {}
+
+@csrf_protect(placeholder_tokens=True)
+def placeholder_view(request):
+    if request.method == 'POST':
+        form = SafeBasicForm(request, request.POST)
+        if form.is_valid():
+            return HttpResponse('Valid: %s' % form.cleaned_data['name'])
+        return HttpResponse(form.as_p())
+    if 'page' not in placeholder_page_cache:
+        placeholder_page_cache['page'] = SafeBasicForm(request).as_p()
+    return HttpResponse(placeholder_page_cache['page'])
+
+@csrf_protect(placeholder_tokens=True)
+def single_use_placeholder_view(request):
+    Form = SafeForm(BasicForm, single_use=True)
+    if request.method == 'POST':
+        form = Form(request, request.POST, prefix='a')
+        if form.is_valid():
+            return HttpResponse('Valid: %s' % form.cleaned_data['name'])
+        return HttpResponse(form.as_p())
+    if 'single-use' not in placeholder_page_cache:
+        placeholder_page_cache['single-use'] = ''.join([
+            Form(request, prefix=prefix).as_p() for prefix in ('a', 'b')
+        ])
+    return HttpResponse(placeholder_page_cache['single-use'])
+
+class UploadForm(forms.Form):
+    name = forms.CharField(max_length = 100)
+    upload = forms.FileField(required = False)
+SafeUploadForm = SafeForm(UploadForm)
+
+@csrf_protect(early_check=True)
+def early_check_view(request, prefix=None):
+    form = SafeUploadForm(request, prefix=prefix)
+    if request.method == 'POST':
+        form = SafeUploadForm(request, request.POST, request.FILES,
+            prefix=prefix
+        )
+        if form.is_valid():
+            return HttpResponse('Valid: %s' % form.cleaned_data['name'])
+    return HttpResponse(form.as_p())
+
+SafePersonFormSet = SafeFormSet(PersonFormSet)
+
+@csrf_protect
+def safe_formset_wrapper_view(request):
+    formset = SafePersonFormSet(request, prefix='people')
+    if request.method == 'POST':
+        formset = SafePersonFormSet(request, request.POST, prefix='people')
+        if formset.is_valid():
+            return HttpResponse('Valid: %s' % ', '.join([
+                form.cleaned_data['name']
+                for form in formset.forms
+                if form.cleaned_data
+            ]))
+    return HttpResponse("""
+        <form action="." method="post">
+        %s %s %s
+        <p><input type="submit"></p>
+        </form>
+    """ % (
+        formset.non_form_errors(),
+        formset.as_table(),
+        formset.management_form,
+    ))
+
+@csrf_protect
+def form_group_view(request):
+    form1 = BasicForm(prefix='basic')
+    form2 = OtherForm(prefix='other')
+    group = SafeFormGroup(request, [form1, form2])
+    if request.method == 'POST':
+        form1 = BasicForm(request.POST, prefix='basic')
+        form2 = OtherForm(request.POST, prefix='other')
+        group = SafeFormGroup(request, [form1, form2], request.POST)
+        if group.is_valid():
+            return HttpResponse('Valid: %s, %s' % (
+                form1.cleaned_data['name'], form2.cleaned_data['email'],
+            ))
+    return HttpResponse("""
+        <form action="." method="post">
+        %s %s %s
+        <p><input type="submit"></p>
+        </form>
+    """ % (group, form1.as_p(), form2.as_p()))
+
+@csrf_protect(lazy_cookie=True)
+def lazy_cookie_view(request):
+    if not request.GET.get('form'):
+        return HttpResponse('No forms here')
+    form = SafeBasicForm(request)
+    if request.method == 'POST':
+        form = SafeBasicForm(request, request.POST)
+        if form.is_valid():
+            return HttpResponse('Valid: %s' % form.cleaned_data['name'])
+    return HttpResponse(form.as_p())
+
 urlpatterns = patterns('',
     (r'^safe-basic-form/$', safe_form_view),
     (r'^safe-get-form/$', safe_get_view),
@@ -156,6 +300,18 @@ urlpatterns = patterns('',
     (r'^safe-form-custom-message/$', safe_form_custom_message_view),
     (r'^safe-form-ajax-skips-false/$', safe_form_ajax_skips_false_view),    
     (r'^hand-rolled/$', hand_rolled_view),
+    (r'^injected/$', injected_view),
+    (r'^injected-streaming/$', injected_streaming_view),
+    (r'^injected-non-ascii/$', injected_non_ascii_view),
     (r'^identifier-form/$', identifier_form_view),
     (r'^expire-after-60-seconds/$', expire_after_60_seconds_form_view),
+    (r'^single-use/$', single_use_form_view),
+    (r'^shed-failures/$', shed_failures_view),
+    (r'^placeholder/$', placeholder_view),
+    (r'^placeholder-single-use/$', single_use_placeholder_view),
+    (r'^early-check/$', early_check_view),
+    (r'^early-check-prefix/$', early_check_view, {'prefix': 'up'}),
+    (r'^safe-formset-wrapper/$', safe_formset_wrapper_view),
+    (r'^form-group/$', form_group_view),
+    (r'^lazy-cookie/$', lazy_cookie_view),
 )
@@ -16,9 +16,39 @@ Things to test:
 from django.test import TestCase
 from django_safeform import csrf_utils
 from django_safeform import test_utils
+from django_safeform.engines import BaseTokenEngine
 from django_safeform.forms import CSRF_INVALID_MESSAGE
 import datetime
 
+not_set = object()
+
+class SettingsTestCase(TestCase):
+    """
+    Change settings with self.set_settings(NAME=value) - the original values
+    are put back after each test, even one that fails
+    """
+    
+    def set_settings(self, **kwargs):
+        from django.conf import settings
+        originals = self.__dict__.setdefault('_original_settings', {})
+        for name, value in kwargs.items():
+            if name not in originals:
+                originals[name] = getattr(settings, name, not_set)
+            setattr(settings, name, value)
+    
+    def restore_settings(self):
+        from django.conf import settings
+        originals = self.__dict__.pop('_original_settings', {})
+        for name, value in originals.items():
+            if value is not_set:
+                delattr(settings, name)
+            else:
+                setattr(settings, name, value)
+    
+    def _post_teardown(self):
+        self.restore_settings()
+        super(SettingsTestCase, self)._post_teardown()
+
 class SafeBasicFormTest(TestCase):
     urls = 'django_safeform.test_views'
     
@@ -127,6 +157,60 @@ class HandRolledFormsTest(TestCase):
         })
         self.assertEqual(response3.content, 'OK')
 
+class TokenInjectionTest(TestCase):
+    urls = 'django_safeform.test_views'
+    
+    def test_tokens_are_injected_into_post_forms_only(self):
+        response = self.client.get('/injected/')
+        self.assertEqual(response.content.count('name="csrf_token"'), 1)
+        inputs = test_utils.extract_input_tags(response.content)
+        response2 = self.client.post('/injected/', {
+            'csrf_token': inputs['csrf_token'],
+        })
+        self.assertEqual(response2.content, 'OK')
+    
+    def test_tokens_are_injected_into_streaming_responses(self):
+        response = self.client.get('/injected-streaming/')
+        content = response.content # Can only be read once, as it streams
+        self.assert_(
+            '<form action="." method="post"><input type="hidden" '
+            'name="csrf_token"' in content
+        )
+        self.assert_(content.endswith('x' * 10000))
+    
+    def test_injection_only_holds_back_unfinished_tags(self):
+        from django_safeform.injection import inject_csrf_tokens
+        chunks = list(inject_csrf_tokens(
+            ['<p>one</p><fo', 'rm method="post">', '<p>two</p>'],
+            lambda: 'token'
+        ))
+        self.assertEqual(chunks, [
+            '<p>one</p>',
+            '<form method="post"><input type="hidden" name="csrf_token" '
+            'value="token">',
+            '<p>two</p>',
+        ])
+    
+    def test_tokens_are_injected_into_non_ascii_pages(self):
+        response = self.client.get('/injected-non-ascii/')
+        self.assert_('Caf\xc3\xa9' in response.content)
+        self.assert_(
+            test_utils.extract_input_tags(response.content)['csrf_token']
+        )
+    
+    def test_forms_posting_to_other_sites_are_skipped(self):
+        from django_safeform.injection import inject_csrf_tokens
+        html = ''.join(inject_csrf_tokens([
+            '<form action="http://elsewhere.com/" method="post">',
+            '<form action=//elsewhere.com/ method=post>',
+            '<form action="https://example.com/" method="post">',
+            '<form action="HTTP://Example.com/next/" method="post">',
+            '<form action="/next/" method="post">',
+            '<form method="post">',
+        ], lambda: 'token', origin='http://example.com'))
+        self.assertEqual(html.count('value="token"'), 3)
+        self.assert_(not '"https://example.com/" method="post"><input' in html)
+
 class IdentifierTest(TestCase):
     urls = 'django_safeform.test_views'
     
@@ -151,7 +235,7 @@ class IdentifierTest(TestCase):
         })
         self.assertEqual(response.content, 'Valid: Test 2')
 
-class ExpireAfterTest(TestCase):
+class ExpireAfterTest(SettingsTestCase):
     urls = 'django_safeform.test_views'
     
     def fetch_token(self, fake):
@@ -192,14 +276,12 @@ class ExpireAfterTest(TestCase):
             })
             self.assertEqual(response.content, 'Valid: Test')
             # Now monkey patch the settings
-            from django.conf import settings
-            settings.CSRF_TOKENS_EXPIRE_AFTER = 24 * 60 * 60
+            self.set_settings(CSRF_TOKENS_EXPIRE_AFTER = 24 * 60 * 60)
             response = self.client.post('/safe-basic-form/', {
                 'name': 'Test',
                 'csrf_token': token,
             })
             self.assert_(CSRF_INVALID_MESSAGE in response.content)
-            settings.CSRF_TOKENS_EXPIRE_AFTER = None
         inner()
 
 class CsrfTestCaseTestCase(test_utils.CsrfTestCase):
@@ -227,3 +309,1163 @@ class CsrfTestCaseTestCase(test_utils.CsrfTestCase):
             'name': 'Test 2',
         }, csrf='identifier-form')
         self.assertEqual(response.content, 'Valid: Test 2')
+
+class FakeRequest(object):
+    def __init__(self, cookie='csrf-cookie'):
+        self.COOKIES = {'_csrf_cookie': cookie}
+        self.META = {}
+        self.method = 'GET'
+
+class HmacCacheTest(SettingsTestCase):
+    def setUp(self):
+        csrf_utils.hmac_cache.clear()
+        self.request = FakeRequest()
+    
+    def test_prepared_hmac_is_reused_for_the_same_cookie(self):
+        token = csrf_utils.new_csrf_token(self.request)
+        self.assertEqual(csrf_utils.hmac_cache.misses, 1)
+        self.assert_(csrf_utils.validate_csrf_token(token, self.request))
+        self.assertEqual(csrf_utils.hmac_cache.hits, 1)
+        self.assertEqual(len(csrf_utils.hmac_cache), 1)
+    
+    def test_changing_secret_key_invalidates_cached_keys(self):
+        from django.conf import settings
+        token = csrf_utils.new_csrf_token(self.request)
+        self.set_settings(SECRET_KEY = settings.SECRET_KEY + 'changed')
+        self.assert_(not csrf_utils.validate_csrf_token(token, self.request))
+        self.restore_settings()
+        self.assert_(csrf_utils.validate_csrf_token(token, self.request))
+
+class BatchTokensTest(TestCase):
+    def setUp(self):
+        self.request = FakeRequest()
+    
+    def test_new_csrf_tokens_returns_one_token_per_identifier(self):
+        tokens = csrf_utils.new_csrf_tokens(self.request, ['a', 'b', 'c'])
+        self.assertEqual(len(tokens), 3)
+        self.assertEqual([t.split(':')[0] for t in tokens], ['a', 'b', 'c'])
+    
+    def test_validate_csrf_tokens_returns_results_in_order(self):
+        tokens = csrf_utils.new_csrf_tokens(self.request, ['a', 'b'])
+        results = csrf_utils.validate_csrf_tokens(self.request, [
+            (tokens[0], 'a'),
+            (tokens[1], 'a'),
+            ('bad-token', 'b'),
+            (tokens[1], 'b'),
+        ])
+        self.assertEqual(results, [True, False, False, True])
+    
+    def test_validate_csrf_tokens_honours_expire_after(self):
+        tokens = csrf_utils.new_csrf_tokens(self.request, ['a'])
+        self.assertEqual(csrf_utils.validate_csrf_tokens(
+            self.request, [(tokens[0], 'a')], expire_after=-1
+        ), [False])
+
+class TimeBucketTest(SettingsTestCase):
+    def setUp(self):
+        self.set_settings(CSRF_TOKEN_TIME_BUCKET = 60)
+        csrf_utils.token_cache.clear()
+        self.request = FakeRequest()
+    
+    def test_tokens_are_identical_within_a_bucket(self):
+        @test_utils.fake_utcnow(datetime.datetime(2009, 1, 1, 0, 0, 5))
+        def first():
+            return csrf_utils.new_csrf_token(self.request)
+        @test_utils.fake_utcnow(datetime.datetime(2009, 1, 1, 0, 0, 55))
+        def second():
+            return csrf_utils.new_csrf_token(self.request)
+        @test_utils.fake_utcnow(datetime.datetime(2009, 1, 1, 0, 1, 5))
+        def next_bucket():
+            return csrf_utils.new_csrf_token(self.request)
+        token = first()
+        self.assertEqual(token, second())
+        self.assertEqual(csrf_utils.token_cache.hits, 1)
+        self.assertNotEqual(token, next_bucket())
+        self.assert_(csrf_utils.validate_csrf_token(token, self.request))
+    
+    def test_tokens_still_depend_on_cookie_and_identifier(self):
+        token = csrf_utils.new_csrf_token(self.request)
+        self.assertNotEqual(token,
+            csrf_utils.new_csrf_token(self.request, 'other')
+        )
+        self.assertNotEqual(token,
+            csrf_utils.new_csrf_token(FakeRequest('other-cookie'))
+        )
+
+class ClockTest(TestCase):
+    def test_system_clock_never_runs_backwards(self):
+        from django_safeform.clock import SystemClock
+        clock = SystemClock()
+        clock._last = clock.now() + 100
+        self.assertEqual(clock.now(), clock._last)
+    
+    def test_fake_clock_only_affects_the_current_thread(self):
+        import threading
+        from django_safeform.clock import get_clock
+        seen = []
+        @test_utils.fake_clock(1000)
+        def inner():
+            thread = threading.Thread(
+                target = lambda: seen.append(get_clock().now())
+            )
+            thread.start()
+            thread.join()
+            return get_clock().now()
+        self.assertEqual(inner(), 1000)
+        self.assertNotEqual(seen[0], 1000)
+    
+    def test_tokens_use_the_clock(self):
+        request = FakeRequest()
+        @test_utils.fake_clock(1000)
+        def inner():
+            return csrf_utils.new_csrf_token(request)
+        self.assertEqual(inner().split(':')[1], '1000')
+
+class SafeFormClassTest(TestCase):
+    def test_wrapped_classes_are_memoized(self):
+        from django_safeform import SafeForm
+        from django_safeform.test_views import BasicForm
+        self.assert_(SafeForm(BasicForm) is SafeForm(BasicForm))
+        self.assert_(SafeForm(BasicForm, identifier='a') is not
+            SafeForm(BasicForm, identifier='b')
+        )
+    
+    def test_wrapped_classes_are_bounded(self):
+        from django_safeform import SafeForm, SafeFormSet
+        from django_safeform.forms import _safe_form_classes, \
+            _safe_formset_classes
+        from django_safeform.test_views import BasicForm, PersonFormSet
+        for i in range(1000):
+            SafeForm(BasicForm, identifier='delete-%d' % i)
+            SafeFormSet(PersonFormSet, identifier='delete-%d' % i)
+        self.assert_(len(_safe_form_classes) <= _safe_form_classes.max_size)
+        self.assert_(
+            len(_safe_formset_classes) <= _safe_formset_classes.max_size
+        )
+    
+    def test_csrf_token_field_is_a_base_field(self):
+        from django_safeform.test_views import SafeBasicForm
+        self.assert_('csrf_token' in SafeBasicForm.base_fields)
+        form = SafeBasicForm(FakeRequest())
+        self.assertEqual(form.fields.keys(), ['name', 'csrf_token'])
+
+class CompactTokenFormatTest(SettingsTestCase):
+    def setUp(self):
+        self.set_settings(CSRF_TOKEN_FORMAT = 'compact')
+        self.request = FakeRequest()
+    
+    def test_compact_tokens_are_short_and_validate(self):
+        token = csrf_utils.new_csrf_token(self.request, 'a-long-identifier')
+        self.assert_(token.startswith('2.'))
+        self.assertEqual(len(token), 31)
+        self.assert_(csrf_utils.validate_csrf_token(
+            token, self.request, 'a-long-identifier'
+        ))
+    
+    def test_compact_tokens_are_bound_to_cookie_and_identifier(self):
+        token = csrf_utils.new_csrf_token(self.request)
+        self.assert_(not csrf_utils.validate_csrf_token(
+            token, self.request, 'other'
+        ))
+        self.assert_(not csrf_utils.validate_csrf_token(
+            token, FakeRequest('other-cookie')
+        ))
+    
+    def test_tampered_compact_tokens_fail(self):
+        token = csrf_utils.new_csrf_token(self.request)
+        flipped = token[:-1] + (token[-1] == 'A' and 'B' or 'A')
+        for bad in (token[:-1], token + 'A', flipped, '2.junk'):
+            self.assert_(not csrf_utils.validate_csrf_token(bad, self.request))
+    
+    def test_compact_tokens_expire(self):
+        @test_utils.fake_clock(1000)
+        def issue():
+            return csrf_utils.new_csrf_token(self.request)
+        token = issue()
+        @test_utils.fake_clock(1061)
+        def validate():
+            return csrf_utils.validate_csrf_token(
+                token, self.request, expire_after=60
+            )
+        self.assert_(not validate())
+    
+    def test_hex_tokens_still_validate_after_switching(self):
+        self.set_settings(CSRF_TOKEN_FORMAT = 'hex')
+        token = csrf_utils.new_csrf_token(self.request)
+        self.set_settings(CSRF_TOKEN_FORMAT = 'compact')
+        self.assert_(csrf_utils.validate_csrf_token(token, self.request))
+
+class KeyRotationTest(SettingsTestCase):
+    def setUp(self):
+        self.request = FakeRequest()
+    
+    def test_tokens_carry_the_key_id_of_the_signing_key(self):
+        from django_safeform.keys import key_id
+        self.set_settings(CSRF_SECRET_KEYS = ['new-key', 'old-key'])
+        token = csrf_utils.new_csrf_token(self.request)
+        self.assert_(token.split(':')[2].startswith(key_id('new-key') + '.'))
+    
+    def test_tokens_signed_with_old_keys_still_validate(self):
+        self.set_settings(CSRF_SECRET_KEYS = ['old-key'])
+        hex_token = csrf_utils.new_csrf_token(self.request)
+        self.set_settings(CSRF_TOKEN_FORMAT = 'compact')
+        compact_token = csrf_utils.new_csrf_token(self.request)
+        self.set_settings(CSRF_TOKEN_FORMAT = 'hex')
+        self.set_settings(CSRF_SECRET_KEYS = ['new-key', 'old-key'])
+        self.assert_(csrf_utils.validate_csrf_token(hex_token, self.request))
+        self.assert_(
+            csrf_utils.validate_csrf_token(compact_token, self.request)
+        )
+        # Once the old key is retired its tokens are rejected
+        self.set_settings(CSRF_SECRET_KEYS = ['new-key'])
+        self.assert_(
+            not csrf_utils.validate_csrf_token(hex_token, self.request)
+        )
+        self.assert_(
+            not csrf_utils.validate_csrf_token(compact_token, self.request)
+        )
+    
+    def test_tokens_without_key_id_are_checked_against_secret_key(self):
+        token = csrf_utils.new_csrf_token(self.request)
+        message, signature = token.rsplit(':', 1)
+        old_style_token = '%s:%s' % (message, signature.split('.')[1])
+        self.assert_(
+            csrf_utils.validate_csrf_token(old_style_token, self.request)
+        )
+    
+    def test_tokens_without_key_id_are_rejected_once_secret_key_retires(self):
+        from django.conf import settings
+        self.set_settings(CSRF_SECRET_KEYS = [settings.SECRET_KEY])
+        token = csrf_utils.new_csrf_token(self.request)
+        message, signature = token.rsplit(':', 1)
+        old_style_token = '%s:%s' % (message, signature.split('.')[1])
+        self.set_settings(CSRF_SECRET_KEYS = ['brand-new-key'])
+        self.assertEqual(csrf_utils.check_csrf_tokens(
+            self.request, [(old_style_token, 'default')]
+        ), ['unknown_key'])
+    
+    def test_keys_are_reloaded_when_the_keys_file_changes(self):
+        import os, tempfile
+        fd, path = tempfile.mkstemp()
+        os.write(fd, '# Current key first\nold-key\n')
+        os.close(fd)
+        self.set_settings(CSRF_SECRET_KEYS_FILE = path)
+        try:
+            @test_utils.fake_clock(1000)
+            def before():
+                return csrf_utils.new_csrf_token(self.request)
+            token = before()
+            fp = open(path, 'w')
+            fp.write('new-key\nold-key\n')
+            fp.close()
+            os.utime(path, (2000, 2000))
+            @test_utils.fake_clock(1010)
+            def after():
+                self.assert_(
+                    csrf_utils.validate_csrf_token(token, self.request)
+                )
+                return csrf_utils.new_csrf_token(self.request)
+            new_token = after()
+            self.assertNotEqual(
+                token.split(':')[2][:4], new_token.split(':')[2][:4]
+            )
+        finally:
+            os.remove(path)
+
+class SingleUseTokenTest(SettingsTestCase):
+    urls = 'django_safeform.test_views'
+    
+    def test_single_use_tokens_cannot_be_replayed(self):
+        response = self.client.get('/single-use/')
+        token = test_utils.extract_input_tags(response.content)['csrf_token']
+        data = {'name': 'Test', 'csrf_token': token}
+        response = self.client.post('/single-use/', data)
+        self.assertEqual(response.content, 'Valid: Test')
+        response = self.client.post('/single-use/', data)
+        self.assert_(CSRF_INVALID_MESSAGE in response.content)
+    
+    def test_form_redisplayed_with_fresh_token_after_other_errors(self):
+        # All within the same second, which used to give the same token
+        @test_utils.fake_clock(csrf_utils._epoch_time())
+        def inner():
+            response = self.client.get('/single-use/')
+            token = test_utils.extract_input_tags(
+                response.content
+            )['csrf_token']
+            response = self.client.post('/single-use/', {
+                'name': '', 'csrf_token': token,
+            })
+            new_token = test_utils.extract_input_tags(
+                response.content
+            )['csrf_token']
+            self.assertNotEqual(new_token, token)
+            response = self.client.post('/single-use/', {
+                'name': 'Test', 'csrf_token': new_token,
+            })
+            self.assertEqual(response.content, 'Valid: Test')
+        inner()
+    
+    def test_tokens_issued_in_the_same_second_are_different(self):
+        request = FakeRequest()
+        @test_utils.fake_clock(csrf_utils._epoch_time())
+        def inner():
+            for format, nonce_at in (
+                    ('hex', lambda token: token.index('-') + 1),
+                    ('compact', lambda token: token.index('.') + 8)):
+                self.set_settings(CSRF_TOKEN_FORMAT = format)
+                tokens = csrf_utils.new_csrf_tokens(
+                    request, ['a', 'a'], single_use=True
+                )
+                self.assertNotEqual(tokens[0], tokens[1])
+                for token in tokens:
+                    self.assertEqual(csrf_utils.check_csrf_tokens(
+                        request, [(token, 'a'), (token, 'a')],
+                        single_use=True,
+                    ), [None, 'already_used'])
+                # The nonce is signed
+                token = tokens[0]
+                i = nonce_at(token)
+                forged = token[:i] + (token[i] == 'A' and 'B' or 'A') \
+                    + token[i + 1:]
+                self.assertEqual(csrf_utils.check_csrf_tokens(
+                    request, [(forged, 'a')]
+                ), ['bad_signature'])
+        inner()
+    
+    def test_tokens_cannot_be_replayed_without_their_key_id(self):
+        request = FakeRequest()
+        for format, strip_kid in (
+                ('hex', lambda token: '%s:%s' % (
+                    token.rsplit(':', 1)[0], token.rsplit('.', 1)[1]
+                )),
+                ('compact', lambda token: '2.' + token.rsplit('.', 1)[1])):
+            self.set_settings(CSRF_TOKEN_FORMAT = format)
+            token = csrf_utils.new_csrf_token(request, 'a', single_use=True)
+            # Still a valid token, checked against SECRET_KEY
+            self.assertEqual(csrf_utils.check_csrf_tokens(
+                request, [(strip_kid(token), 'a')]
+            ), [None])
+            self.assertEqual(csrf_utils.check_csrf_tokens(
+                request, [(token, 'a'), (strip_kid(token), 'a')],
+                single_use=True,
+            ), [None, 'malformed'])
+    
+    def test_tokens_without_a_nonce_are_not_single_use(self):
+        request = FakeRequest()
+        for format in ('hex', 'compact'):
+            self.set_settings(CSRF_TOKEN_FORMAT = format)
+            token = csrf_utils.new_csrf_token(request, 'a')
+            self.assertEqual(csrf_utils.check_csrf_tokens(
+                request, [(token, 'a')], single_use=True
+            ), ['malformed'])
+    
+    def test_replacement_token_is_only_issued_when_rendered(self):
+        from django.http import QueryDict
+        from django_safeform.test_views import BasicForm
+        from django_safeform.forms import SafeForm
+        request = FakeRequest()
+        request.is_ajax = lambda: False
+        Form = SafeForm(BasicForm, single_use=True)
+        token = csrf_utils.new_csrf_token(request, single_use=True)
+        csrf_utils.hmac_cache.clear()
+        form = Form(request, QueryDict('name=Test&csrf_token=%s' % token))
+        self.assert_(form.is_valid())
+        self.assertEqual(csrf_utils.hmac_cache.misses, 1) # Checking only
+        self.assertNotEqual(
+            test_utils.extract_input_tags(form.as_p())['csrf_token'], token
+        )
+        self.assertEqual(csrf_utils.hmac_cache.hits, 1)
+
+class UsedTokenStoreTest(TestCase):
+    def assert_store_works(self, store):
+        self.assert_(store.add('token-1'))
+        self.assert_(not store.add('token-1'))
+        self.assert_(store.add('token-2', ttl=10))
+        @test_utils.fake_clock(csrf_utils._epoch_time() + 11)
+        def later():
+            # token-2 has expired, so it can be recorded again
+            self.assert_(store.add('token-2'))
+            self.assert_(not store.add('token-1'))
+        later()
+    
+    def test_memory_store(self):
+        from django_safeform.stores import MemoryTokenStore
+        self.assert_store_works(MemoryTokenStore())
+    
+    def test_memory_store_is_bounded(self):
+        from django_safeform.stores import MemoryTokenStore
+        store = MemoryTokenStore(max_size=64, stripes=4)
+        for i in range(1000):
+            store.add('token-%d' % i)
+        self.assert_(len(store) <= 64)
+    
+    def test_sqlite_store(self):
+        import os, tempfile
+        from django_safeform.stores import SQLiteTokenStore
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            self.assert_store_works(SQLiteTokenStore(path))
+            # A second store on the same file sees the same tokens
+            self.assert_(not SQLiteTokenStore(path).add('token-1'))
+        finally:
+            for filename in (path, path + '-wal', path + '-shm'):
+                if os.path.exists(filename):
+                    os.remove(filename)
+
+class BenchmarkTest(TestCase):
+    def test_every_benchmark_runs(self):
+        from django_safeform import benchmarks
+        results = benchmarks.run_benchmarks(min_time=0, repeat=1)
+        self.assertEqual(sorted(results),
+            sorted([name for name, setup in benchmarks.registry])
+        )
+        for result in results.values():
+            self.assert_(result['ops_per_sec'] > 0)
+    
+    def test_regressions_are_found_against_a_saved_baseline(self):
+        import os, tempfile
+        from django_safeform import benchmarks
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            benchmarks.save_baseline({
+                'a': {'ops_per_sec': 1000.0, 'allocations': 0.0},
+                'b': {'ops_per_sec': 1000.0, 'allocations': 0.0},
+            }, path)
+            baseline = benchmarks.load_baseline(path)
+        finally:
+            os.remove(path)
+        results = {
+            'a': {'ops_per_sec': 950.0, 'allocations': 0.0},
+            'b': {'ops_per_sec': 850.0, 'allocations': 0.0},
+            'c': {'ops_per_sec': 1.0, 'allocations': 0.0},
+        }
+        self.assertEqual(
+            benchmarks.find_regressions(results, baseline, threshold=10),
+            [('b', 1000.0, 850.0)]
+        )
+        self.assertEqual(
+            benchmarks.find_regressions(results, baseline, threshold=20), []
+        )
+    
+    def test_superlinear_scaling_is_found(self):
+        from django_safeform import benchmarks
+        results = {
+            'extract_input_tags:10KB': {'ops_per_sec': 1000.0},
+            'extract_input_tags:100KB': {'ops_per_sec': 100.0},
+            'extract_input_tags:1MB': {'ops_per_sec': 1.0},
+        }
+        self.assertEqual(benchmarks.find_scaling_problems(results), [
+            ('extract_input_tags:100KB', 'extract_input_tags:1MB', 100.0),
+        ])
+
+class StatsTest(SettingsTestCase):
+    def setUp(self):
+        from django_safeform.stats import get_stats
+        self.set_settings(
+            CSRF_STATS = 'django_safeform.stats.MemoryStats',
+            CSRF_STATS_PER_IDENTIFIER = True,
+        )
+        self.stats = get_stats()
+        self.stats.reset()
+        self.request = FakeRequest()
+    
+    def test_issuance_is_counted_and_timed(self):
+        csrf_utils.new_csrf_tokens(self.request, ['a', 'b', 'a'])
+        self.assertEqual(self.stats.counters['issued'], 3)
+        self.assertEqual(self.stats.counters['issued.a'], 2)
+        self.assertEqual(sum(self.stats.histograms['issue']), 1)
+    
+    def test_rejections_are_counted_by_reason_and_identifier(self):
+        token = csrf_utils.new_csrf_token(self.request, 'a')
+        @test_utils.fake_clock(csrf_utils._epoch_time() + 61)
+        def later():
+            return csrf_utils.check_csrf_tokens(self.request, [
+                (token, 'a'),
+                (token, 'b'),
+                ('junk', 'a'),
+                ('', 'a'),
+            ], expire_after=60)
+        self.assertEqual(later(), [
+            'expired', 'wrong_identifier', 'malformed', 'missing',
+        ])
+        # Expiry is checked first, so tamper with a token that is still fresh
+        self.assertEqual(csrf_utils.check_csrf_tokens(self.request, [
+            (token[:-1] + (token[-1] == '0' and '1' or '0'), 'a'),
+        ]), ['bad_signature'])
+        self.assert_(csrf_utils.validate_csrf_token(token, self.request, 'a'))
+        counters = self.stats.counters
+        self.assertEqual(counters['accepted.a'], 1)
+        self.assertEqual(counters['rejected.expired.a'], 1)
+        self.assertEqual(counters['rejected.wrong_identifier.b'], 1)
+        self.assertEqual(counters['rejected.malformed'], 1)
+        self.assertEqual(counters['rejected.bad_signature.a'], 1)
+        self.assertEqual(sum(self.stats.histograms['validate']), 3)
+    
+    def test_forms_record_the_rejection_reason(self):
+        from django.http import QueryDict
+        from django_safeform.test_views import SafeBasicForm
+        self.request.is_ajax = lambda: False
+        form = SafeBasicForm(self.request, QueryDict('name=Test'))
+        self.assert_(not form.is_valid())
+        self.assertEqual(form.csrf_rejection_reason, 'missing')
+        self.assertEqual(self.stats.counters['rejected.missing.default'], 1)
+    
+    def test_per_identifier_counters_are_opt_in(self):
+        self.set_settings(CSRF_STATS_PER_IDENTIFIER = False)
+        token = csrf_utils.new_csrf_token(self.request, 'a')
+        csrf_utils.validate_csrf_token(token, self.request, 'a')
+        self.assertEqual(self.stats.counters, {'issued': 1, 'accepted': 1})
+    
+    def test_identifiers_are_made_safe_for_metric_names(self):
+        csrf_utils.new_csrf_token(self.request, 'delete:1|c@0.5 x')
+        self.assertEqual(
+            self.stats.counters['issued.delete_1_c_0_5_x'], 1
+        )
+    
+    def test_number_of_counters_is_bounded(self):
+        from django_safeform.stats import MemoryStats
+        stats = MemoryStats(max_names=2)
+        for name in ('a', 'b', 'c', 'd', 'a'):
+            stats.incr(name)
+        self.assertEqual(stats.counters, {'a': 2, 'b': 1, 'dropped': 2})
+
+class PreCheckTest(TestCase):
+    def setUp(self):
+        csrf_utils.hmac_cache.clear()
+        self.request = FakeRequest()
+    
+    def test_junk_and_stale_tokens_are_rejected_without_an_hmac(self):
+        signature = '0' * 40
+        for token, reason in (
+                ('x' * 40, 'malformed'),
+                ('default:%s' % ('x' * 2000), 'malformed'),
+                ('default:not-a-time:%s' % signature, 'malformed'),
+                ('default:1000:%s' % signature[:-1], 'malformed'),
+                ('default:1000:%s' % ('A' * 40), 'malformed'),
+                ('other:1000:%s' % signature, 'wrong_identifier'),
+                ('default:1000:%s' % signature, 'expired'),
+                ('2.%s' % ('!' * 24), 'malformed'),
+            ):
+            self.assertEqual(csrf_utils.check_csrf_tokens(
+                self.request, [(token, 'default')], expire_after=60
+            ), [reason])
+        self.assertEqual(csrf_utils.hmac_cache.misses, 0)
+    
+    def test_plausible_tokens_still_need_a_valid_signature(self):
+        token = '%s:%s' % (
+            csrf_utils.new_csrf_token(self.request).rsplit(':', 1)[0],
+            '0' * 40,
+        )
+        self.assertEqual(csrf_utils.check_csrf_tokens(
+            self.request, [(token, 'default')]
+        ), ['bad_signature'])
+    
+    def test_identifiers_may_contain_colons(self):
+        token = csrf_utils.new_csrf_token(self.request, 'a:b')
+        self.assert_(csrf_utils.validate_csrf_token(token, self.request, 'a:b'))
+    
+    def test_constant_time_compare(self):
+        compare = csrf_utils._constant_time_compare
+        self.assert_(compare('abc', 'abc'))
+        self.assert_(not compare('abc', 'abd'))
+        self.assert_(not compare('abc', 'ab'))
+
+class CookieSecretTest(TestCase):
+    def test_secrets_are_fixed_length_and_url_safe(self):
+        import re
+        from django_safeform.cookies import SecretGenerator
+        generate = SecretGenerator(num_bytes=24, per_block=4)
+        secrets = [generate() for i in range(10)]
+        self.assertEqual(len(set(secrets)), 10)
+        for secret in secrets:
+            self.assert_(re.match(r'^[A-Za-z0-9_-]{32}$', secret), secret)
+    
+    def test_secrets_are_unique_across_threads(self):
+        import threading
+        from django_safeform.cookies import SecretGenerator
+        generate = SecretGenerator(per_block=3)
+        seen = []
+        def worker():
+            seen.extend([generate() for i in range(200)])
+        threads = [threading.Thread(target=worker) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(seen)), 1600)
+    
+    def test_buffer_is_discarded_after_fork(self):
+        from django_safeform.cookies import SecretGenerator
+        generate = SecretGenerator()
+        generate()
+        generate._pid = -1 # As if we were now in a child process
+        generate()
+        self.assertEqual(generate._pos, generate.length)
+
+class CookieTest(TestCase):
+    urls = 'django_safeform.test_views'
+    
+    def test_new_cookies_are_random_url_safe_values(self):
+        cookie1 = self.client.get('/safe-basic-form/').cookies['_csrf_cookie']
+        self.client.cookies.clear()
+        cookie2 = self.client.get('/safe-basic-form/').cookies['_csrf_cookie']
+        self.assertEqual(len(cookie1.value), 32)
+        self.assertNotEqual(cookie1.value, cookie2.value)
+
+class FailureLimiterTest(SettingsTestCase):
+    urls = 'django_safeform.test_views'
+    
+    def setUp(self):
+        self.set_settings(CSRF_FAILURE_LIMITER_OPTIONS = {
+            'capacity': 2, 'refill_rate': 0.1,
+        })
+        self.now = csrf_utils._epoch_time()
+    
+    def post(self, token, seconds_later=0):
+        @test_utils.fake_clock(self.now + seconds_later)
+        def inner():
+            return self.client.post('/shed-failures/', {
+                'csrf_token': token, 'name': 'Test',
+            })
+        return inner()
+    
+    def test_repeat_offenders_are_turned_away(self):
+        response = self.client.get('/shed-failures/')
+        token = test_utils.extract_input_tags(response.content)['csrf_token']
+        for i in range(2):
+            response = self.post('bad-token')
+            self.assert_(CSRF_INVALID_MESSAGE in response.content)
+        response = self.post(token)
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(response['Retry-After'], '10')
+        # Once the bucket has refilled the client can submit again
+        response = self.post(token, seconds_later=10)
+        self.assertEqual(response.content, 'Valid: Test')
+    
+    def test_limiter_is_bounded(self):
+        from django_safeform.limiter import FailureLimiter
+        limiter = FailureLimiter(max_size=10)
+        for i in range(100):
+            request = FakeRequest('cookie-%d' % i)
+            limiter.record_failure(request)
+        self.assertEqual(len(limiter.buckets), 10)
+    
+    def test_clients_without_cookies_are_keyed_on_address(self):
+        from django_safeform.limiter import FailureLimiter
+        limiter = FailureLimiter(capacity=1, refill_rate=0)
+        request = FakeRequest('')
+        request.META['REMOTE_ADDR'] = '10.0.0.1'
+        limiter.record_failure(request)
+        self.assert_(not limiter.allow(request))
+        other = FakeRequest('')
+        other.META['REMOTE_ADDR'] = '10.0.0.2'
+        self.assert_(limiter.allow(other))
+
+class ExtractInputTagsTest(TestCase):
+    def test_awkward_tags_are_parsed(self):
+        html = '''
+            <INPUT TYPE=hidden NAME=csrf_token VALUE=abc123>
+            <input type="text"
+                   name="multi"
+                   value='line'>
+            <input type="checkbox" name="checked" checked />
+            <input name="escaped" value="a &amp; b">
+            <p>name="not-an-input"</p>
+        '''
+        self.assertEqual(test_utils.extract_input_tags(html), {
+            'csrf_token': 'abc123',
+            'multi': 'line',
+            'checked': '',
+            'escaped': 'a & b',
+        })
+    
+    def test_html_can_be_read_in_chunks(self):
+        html = '<p><input type="hidden" name="csrf_token" value="abc123"></p>'
+        for split in range(len(html)):
+            self.assertEqual(test_utils.extract_input_tags(
+                iter([html[:split], html[split:]])
+            ), {'csrf_token': 'abc123'})
+    
+    def test_streaming_responses_can_be_read(self):
+        from django.http import HttpResponse
+        response = HttpResponse(iter([
+            '<form><input name="a" ', 'value="1"><input name="b" value="2">'
+        ]))
+        self.assertEqual(
+            test_utils.extract_input_tags(response), {'a': '1', 'b': '2'}
+        )
+
+class LoadTestTest(TestCase):
+    def test_flows_run_concurrently_with_separate_cookie_jars(self):
+        from django_safeform import loadtest
+        result = loadtest.run_load('/safe-basic-form/', {'name': 'Test'},
+            flows = 20, threads = 4, urlconf = 'django_safeform.test_views',
+        )
+        self.assertEqual(result.flows(), 20)
+        self.assertEqual(result.errors, 0)
+        self.assertEqual(result.rejection_rate(), 0.0)
+        self.assert_(result.throughput() > 0)
+        self.assert_(result.percentile(50) <= result.percentile(99))
+    
+    def test_rejections_are_reported(self):
+        from django_safeform import loadtest
+        result = loadtest.run_load('/safe-basic-form/', {
+            'name': 'Test', 'csrf_token': 'bad-token',
+        }, flows = 6, threads = 2, get_first = False,
+            urlconf = 'django_safeform.test_views',
+        )
+        self.assertEqual(result.rejection_rate(), 1.0)
+    
+    def test_percentiles(self):
+        from django_safeform.loadtest import LoadResult
+        result = LoadResult([float(i) for i in range(1, 101)], 0, 0, 1.0)
+        self.assertEqual(result.percentile(50), 50.0)
+        self.assertEqual(result.percentile(99), 99.0)
+        self.assertEqual(result.percentile(100), 100.0)
+
+class PlaceholderTokenTest(TestCase):
+    urls = 'django_safeform.test_views'
+    
+    def setUp(self):
+        from django_safeform.test_views import placeholder_page_cache
+        placeholder_page_cache.clear()
+    
+    def test_cached_pages_get_a_real_token_for_each_visitor(self):
+        from django_safeform.test_views import placeholder_page_cache
+        from django.test.client import Client
+        client1, client2 = Client(), Client()
+        token1 = test_utils.extract_input_tags(
+            client1.get('/placeholder/').content
+        )['csrf_token']
+        self.assert_('__csrf_placeholder_' in placeholder_page_cache['page'])
+        token2 = test_utils.extract_input_tags(
+            client2.get('/placeholder/').content
+        )['csrf_token']
+        self.assertNotEqual(token1, token2)
+        for client, token in ((client1, token1), (client2, token2)):
+            response = client.post('/placeholder/', {
+                'name': 'Test', 'csrf_token': token,
+            })
+            self.assertEqual(response.content, 'Valid: Test')
+        response = client1.post('/placeholder/', {
+            'name': 'Test', 'csrf_token': token2,
+        })
+        self.assert_(CSRF_INVALID_MESSAGE in response.content)
+    
+    def test_placeholders_split_between_chunks_are_substituted(self):
+        from django_safeform.injection import (
+            placeholder, substitute_placeholders
+        )
+        html = '<input name="csrf_token" value="%s"><p>x</p>' \
+            '<input value="%s" name="prefix-csrf_token">' % (
+            placeholder('a'), placeholder('b')
+        )
+        for split in range(len(html)):
+            self.assertEqual(''.join(substitute_placeholders(
+                [html[:split], html[split:]], lambda i, once: 'token-' + i
+            )), '<input name="csrf_token" value="token-a"><p>x</p>'
+                '<input value="token-b" name="prefix-csrf_token">')
+    
+    def test_placeholders_outside_csrf_token_inputs_are_left_alone(self):
+        from django_safeform.injection import (
+            placeholder, substitute_placeholders
+        )
+        html = ''.join([
+            '<p>%s</p>',
+            '<img src="http://evil.example.com/?%s">',
+            '<input name="bio" value="%s">',
+            '<input name="not_csrf_token" value="%s">',
+        ]).replace('%s', placeholder('default'))
+        self.assertEqual(''.join(substitute_placeholders(
+            [html], lambda i, once: 'token'
+        )), html)
+    
+    def test_made_up_placeholders_are_left_alone(self):
+        from django_safeform.injection import (
+            placeholder, substitute_placeholders
+        )
+        html = '<input name="csrf_token" value="%s">' % (
+            '__csrf_placeholder_64656661756c74_%s__' % ('0' * 16)
+        )
+        self.assertEqual(''.join(substitute_placeholders(
+            [html], lambda i, once: 'token'
+        )), html)
+        # Nor can a signed placeholder be marked single-use
+        html = '<input name="csrf_token" value="%s">' % placeholder(
+            'default'
+        ).replace('placeholder_', 'placeholder_once_')
+        self.assertEqual(''.join(substitute_placeholders(
+            [html], lambda i, once: 'token'
+        )), html)
+    
+    def test_single_use_placeholders_get_a_token_each(self):
+        from django_safeform.test_views import placeholder_page_cache
+        @test_utils.fake_clock(csrf_utils._epoch_time())
+        def inner():
+            response = self.client.get('/placeholder-single-use/')
+            self.assert_('__csrf_placeholder_once_' in
+                placeholder_page_cache['single-use']
+            )
+            tokens = [
+                attrs['value'] for attrs in
+                test_utils.extract_input_tag_attrs(response.content)
+                if attrs.get('name', '').endswith('csrf_token')
+            ]
+            # Two tabs opened in the same second
+            tokens.append(test_utils.extract_input_tags(
+                self.client.get('/placeholder-single-use/').content
+            )['a-csrf_token'])
+            self.assertEqual(len(set(tokens)), 3)
+            for token in tokens:
+                response = self.client.post('/placeholder-single-use/', {
+                    'a-name': 'Test', 'a-csrf_token': token,
+                })
+                self.assertEqual(response.content, 'Valid: Test')
+        inner()
+
+class EarlyCheckTest(TestCase):
+    urls = 'django_safeform.test_views'
+    
+    def get_token(self):
+        response = self.client.get('/early-check/')
+        return test_utils.extract_input_tags(response.content)['csrf_token']
+    
+    def multipart(self, token, name='Test'):
+        parts = []
+        for field, value in (('csrf_token', token), ('name', name)):
+            parts.append('--XyZ\r\nContent-Disposition: form-data; '
+                'name="%s"\r\n\r\n%s\r\n' % (field, value))
+        return ''.join(parts) + '--XyZ--\r\n'
+    
+    def post(self, body, **extra):
+        return self.client.post('/early-check/', body,
+            content_type='multipart/form-data; boundary=XyZ', **extra
+        )
+    
+    def test_token_in_header(self):
+        token = self.get_token()
+        response = self.client.post('/early-check/', {'name': 'Test'},
+            HTTP_X_CSRF_TOKEN = token
+        )
+        self.assertEqual(response.content, 'Valid: Test')
+        response = self.client.post('/early-check/', {
+            'name': 'Test', 'csrf_token': token,
+        }, HTTP_X_CSRF_TOKEN = 'bad-token')
+        self.assertEqual(response.status_code, 403)
+    
+    def test_token_in_leading_multipart_field(self):
+        token = self.get_token()
+        self.assertEqual(self.post(self.multipart(token)).content,
+            'Valid: Test'
+        )
+        self.assertEqual(self.post(self.multipart('bad-token')).status_code,
+            403
+        )
+    
+    def test_missing_token_is_rejected(self):
+        self.get_token()
+        response = self.client.post('/early-check/', {'name': 'Test'})
+        self.assertEqual(response.status_code, 403)
+    
+    def assert_token_is_sent_first(self, path, token_name):
+        response = self.client.get(path)
+        inputs = test_utils.extract_input_tag_attrs(response.content)
+        self.assertEqual(inputs[0]['name'], token_name)
+        self.assertEqual(response.content.count('csrf_token'), 1)
+        # Sent in page order, as a browser would
+        parts = []
+        for attrs in inputs:
+            parts.append('--XyZ\r\nContent-Disposition: form-data; '
+                'name="%s"\r\n\r\n%s\r\n' % (
+                    attrs['name'], attrs.get('value') or 'Test'
+                ))
+        response = self.client.post(path, ''.join(parts) + '--XyZ--\r\n',
+            content_type='multipart/form-data; boundary=XyZ'
+        )
+        self.assertEqual(response.content, 'Valid: Test')
+    
+    def test_multipart_forms_render_the_token_first(self):
+        self.assert_token_is_sent_first('/early-check/', 'csrf_token')
+    
+    def test_forms_with_a_prefix(self):
+        self.assert_token_is_sent_first('/early-check-prefix/', 'up-csrf_token')
+    
+    def test_multipart_formsets_render_the_token_first(self):
+        from django.forms.formsets import formset_factory
+        from django_safeform.forms import SafeFormSet
+        from django_safeform.test_views import UploadForm
+        FormSet = SafeFormSet(formset_factory(UploadForm))
+        inputs = test_utils.extract_input_tag_attrs(
+            FormSet(FakeRequest(), prefix='files').as_table()
+        )
+        self.assertEqual(inputs[0]['name'], 'files-csrf_token')
+    
+    def test_urlencoded_posts_are_left_to_safeform(self):
+        token = self.get_token()
+        urlencoded = 'application/x-www-form-urlencoded'
+        response = self.client.post('/early-check/',
+            'name=Test&csrf_token=%s' % token, content_type=urlencoded
+        )
+        self.assertEqual(response.content, 'Valid: Test')
+        response = self.client.post('/early-check/', 'name=Test',
+            content_type=urlencoded
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assert_(CSRF_INVALID_MESSAGE in response.content)
+    
+    def test_only_the_start_of_the_body_is_read(self):
+        import StringIO
+        from django.http import HttpRequest
+        from django_safeform.uploads import leading_multipart_field
+        body = self.multipart('token') + 'x' * 100000
+        stream = StringIO.StringIO(body)
+        request = HttpRequest()
+        request.environ = {'wsgi.input': stream}
+        request.META = {
+            'CONTENT_TYPE': 'multipart/form-data; boundary=XyZ',
+            'CONTENT_LENGTH': str(len(body)),
+        }
+        self.assertEqual(leading_multipart_field(request), 'token')
+        self.assertEqual(stream.tell(), 4096)
+        # Everything that was read is put back for Django to parse
+        self.assertEqual(request.environ['wsgi.input'].read(), body)
+    
+    def test_head_is_put_back_into_a_wrapped_stream(self):
+        import StringIO
+        from django.http import HttpRequest
+        from django_safeform.uploads import leading_multipart_field
+        body = self.multipart('token')
+        request = HttpRequest()
+        # As made by Django 1.3 and later
+        request._stream = StringIO.StringIO(body)
+        request.environ = {'wsgi.input': StringIO.StringIO(body)}
+        request.META = {
+            'CONTENT_TYPE': 'multipart/form-data; boundary=XyZ',
+            'CONTENT_LENGTH': str(len(body)),
+        }
+        self.assertEqual(leading_multipart_field(request), 'token')
+        self.assertEqual(request._stream.read(), body)
+        self.assertEqual(request.environ['wsgi.input'].tell(), 0)
+
+class SafeFormSetTest(TestCase):
+    urls = 'django_safeform.test_views'
+    
+    def test_formset_has_one_prefixed_token(self):
+        response = self.client.get('/safe-formset-wrapper/')
+        self.assertEqual(response.content.count('csrf_token'), 1)
+        data = test_utils.extract_input_tags(response.content)
+        self.assert_('people-csrf_token' in data)
+        data.update({
+            'people-0-name': 'Simon', 'people-0-email': 'simon@example.com',
+        })
+        response = self.client.post('/safe-formset-wrapper/', data)
+        self.assertEqual(response.content, 'Valid: Simon')
+        data['people-csrf_token'] = 'bad-token'
+        response = self.client.post('/safe-formset-wrapper/', data)
+        self.assert_(CSRF_INVALID_MESSAGE in response.content)
+    
+    def test_wrapped_formsets_are_memoized(self):
+        from django_safeform import SafeFormSet
+        from django_safeform.test_views import PersonFormSet
+        self.assert_(SafeFormSet(PersonFormSet) is SafeFormSet(PersonFormSet))
+
+class SafeFormGroupTest(TestCase):
+    urls = 'django_safeform.test_views'
+    
+    def test_group_of_forms_shares_one_token(self):
+        response = self.client.get('/form-group/')
+        self.assertEqual(response.content.count('csrf_token'), 1)
+        data = test_utils.extract_input_tags(response.content)
+        data.update({'basic-name': 'Test', 'other-email': 'a@example.com'})
+        response = self.client.post('/form-group/', data)
+        self.assertEqual(response.content, 'Valid: Test, a@example.com')
+        data['csrf_token'] = 'bad-token'
+        response = self.client.post('/form-group/', data)
+        self.assert_(CSRF_INVALID_MESSAGE in response.content)
+
+class LazyTokenTest(TestCase):
+    def setUp(self):
+        csrf_utils.hmac_cache.clear()
+    
+    def test_token_is_only_issued_when_rendered(self):
+        from django_safeform.test_views import SafeBasicForm
+        form = SafeBasicForm(FakeRequest())
+        self.assertEqual(csrf_utils.hmac_cache.misses, 0)
+        html = form.as_p()
+        self.assertEqual(csrf_utils.hmac_cache.misses, 1)
+        # Rendering again reuses the same token
+        self.assertEqual(form.as_p(), html)
+        self.assertEqual(csrf_utils.hmac_cache.hits, 0)
+        token = test_utils.extract_input_tags(html)['csrf_token']
+        self.assert_(csrf_utils.validate_csrf_token(token, FakeRequest()))
+    
+    def test_initial_argument_is_not_modified(self):
+        from django_safeform.test_views import SafeBasicForm
+        initial = {'name': 'Simon'}
+        form = SafeBasicForm(FakeRequest(), initial=initial)
+        self.assertEqual(initial, {'name': 'Simon'})
+        self.assert_('value="Simon"' in form.as_p())
+
+class HashAlgorithmTest(SettingsTestCase):
+    def setUp(self):
+        self.request = FakeRequest()
+    
+    def available_algorithms(self):
+        from django_safeform.algorithms import algorithms
+        return [name for name in algorithms if algorithms[name].available()]
+    
+    def test_tokens_from_every_algorithm_validate_together(self):
+        tokens = []
+        for name in self.available_algorithms():
+            self.set_settings(CSRF_HASH_ALGORITHM = name)
+            for format in ('hex', 'compact'):
+                self.set_settings(CSRF_TOKEN_FORMAT = format)
+                tokens.append(csrf_utils.new_csrf_token(self.request))
+        self.set_settings(CSRF_HASH_ALGORITHM = 'sha1')
+        for token in tokens:
+            self.assert_(
+                csrf_utils.validate_csrf_token(token, self.request), token
+            )
+            self.assert_(not csrf_utils.validate_csrf_token(
+                token, FakeRequest('other-cookie')
+            ), token)
+    
+    def test_tokens_record_the_algorithm(self):
+        from django_safeform.keys import key_id
+        from django.conf import settings
+        self.set_settings(CSRF_HASH_ALGORITHM = 'sha256')
+        token = csrf_utils.new_csrf_token(self.request)
+        label, signature = token.split(':')[2].split('.')
+        self.assertEqual(label, 's256-' + key_id(settings.SECRET_KEY))
+        self.assertEqual(len(signature), 64)
+        # Changing the tag to one that signed nothing is caught
+        forged = token.replace('s256-', 'b2b-')
+        self.assertNotEqual(csrf_utils.check_csrf_tokens(
+            self.request, [(forged, 'default')]
+        ), [None])
+        self.assertEqual(csrf_utils.check_csrf_tokens(
+            self.request, [(token.replace('s256-', 'xxx-'), 'default')]
+        ), ['malformed'])
+    
+    def test_unknown_algorithm_setting(self):
+        from django.core.exceptions import ImproperlyConfigured
+        self.set_settings(CSRF_HASH_ALGORITHM = 'md5')
+        self.assertRaises(ImproperlyConfigured,
+            csrf_utils.new_csrf_token, self.request
+        )
+
+class LazyImportTest(TestCase):
+    def test_csrf_utils_does_not_import_django_forms(self):
+        from django_safeform.benchmarks import fresh_import
+        modules = fresh_import(
+            'import django_safeform, django_safeform.csrf_utils'
+        )
+        self.assert_('django_safeform.csrf_utils' in modules)
+        self.assert_('django.forms' not in modules)
+        self.assert_('django.forms' in fresh_import(
+            'from django_safeform import SafeForm'
+        ))
+    
+    def test_form_classes_are_loaded_on_first_use(self):
+        import django_safeform
+        from django_safeform import forms
+        self.assert_(django_safeform.SafeForm is forms.SafeForm)
+        self.assert_(django_safeform.CsrfForm is forms.CsrfForm)
+        self.assertRaises(AttributeError, getattr, django_safeform, 'Missing')
+
+class LazyCookieTest(TestCase):
+    urls = 'django_safeform.test_views'
+    
+    def test_no_cookie_without_a_token(self):
+        response = self.client.get('/lazy-cookie/')
+        self.assert_(not response.cookies.has_key('_csrf_cookie'))
+        self.assert_(not response.has_header('Vary'))
+    
+    def test_cookie_and_vary_when_a_token_is_issued(self):
+        response = self.client.get('/lazy-cookie/', {'form': '1'})
+        self.assert_(response.cookies.has_key('_csrf_cookie'))
+        self.assert_('Cookie' in response['Vary'])
+        token = test_utils.extract_input_tags(response.content)['csrf_token']
+        response = self.client.post('/lazy-cookie/?form=1', {
+            'csrf_token': token, 'name': 'Test',
+        })
+        self.assertEqual(response.content, 'Valid: Test')
+
+class PlainTokenEngine(BaseTokenEngine):
+    "Unsigned tokens, so the tests can tell this engine is in use"
+    
+    # No single_use argument, as an engine without single-use tokens can
+    # leave it out
+    def issue(self, request, identifiers):
+        cookie = self.get_cookie(request)
+        return ['plain:%s:%s' % (identifier, cookie)
+            for identifier in identifiers]
+    
+    def check(self, request, tokens_and_identifiers, expire_after):
+        cookie = self.get_cookie(request)
+        reasons = []
+        for token, identifier in tokens_and_identifiers:
+            if not token:
+                reasons.append('missing')
+            elif token != 'plain:%s:%s' % (identifier, cookie):
+                reasons.append('bad_signature')
+            else:
+                reasons.append(None)
+        return reasons
+
+class TokenEngineTest(SettingsTestCase):
+    urls = 'django_safeform.test_views'
+    
+    def setUp(self):
+        self.set_settings(
+            CSRF_TOKEN_ENGINE = 'django_safeform.tests.PlainTokenEngine',
+            CSRF_TOKEN_ENGINE_OPTIONS = {'cookie_name': 'plain_cookie'},
+        )
+    
+    def test_default_engine(self):
+        from django_safeform.engines import get_token_engine, HmacTokenEngine
+        self.restore_settings()
+        engine = get_token_engine()
+        self.assert_(isinstance(engine, HmacTokenEngine))
+        self.assertEqual(engine.cookie_name, '_csrf_cookie')
+    
+    def test_tokens_come_from_the_engine(self):
+        request = FakeRequest()
+        request.COOKIES = {'plain_cookie': 'abc'}
+        token = csrf_utils.new_csrf_token(request, 'a')
+        self.assertEqual(token, 'plain:a:abc')
+        self.assertEqual(csrf_utils.check_csrf_tokens(request, [
+            (token, 'a'), (token, 'b'), ('', 'a'),
+        ]), [None, 'bad_signature', 'missing'])
+    
+    def test_single_use_applies_to_any_engine(self):
+        request = FakeRequest()
+        request.COOKIES = {'plain_cookie': 'single-use-engine'}
+        token = csrf_utils.new_csrf_token(request)
+        self.assert_(csrf_utils.validate_csrf_token(
+            token, request, single_use=True
+        ))
+        self.assert_(not csrf_utils.validate_csrf_token(
+            token, request, single_use=True
+        ))
+    
+    def test_forms_and_decorator_use_the_engine(self):
+        client = test_utils.CsrfClient()
+        response = client.get('/safe-basic-form/')
+        self.assert_(response.cookies.has_key('plain_cookie'))
+        self.assert_(not response.cookies.has_key('_csrf_cookie'))
+        cookie = response.cookies['plain_cookie'].value
+        token = test_utils.extract_input_tags(response.content)['csrf_token']
+        self.assertEqual(token, 'plain:default:%s' % cookie)
+        response = client.post('/safe-basic-form/', {'name': 'Test'})
+        self.assertEqual(response.content, 'Valid: Test')
+    
+    def test_unknown_engine(self):
+        from django.core.exceptions import ImproperlyConfigured
+        from django_safeform.engines import get_token_engine
+        self.set_settings(
+            CSRF_TOKEN_ENGINE = 'django_safeform.tests.Missing'
+        )
+        self.assertRaises(ImproperlyConfigured, get_token_engine)
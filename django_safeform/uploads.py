@@ -0,0 +1,129 @@
+import re
+from django.http import HttpResponseForbidden
+from csrf_utils import check_csrf_tokens
+
+# Checking the token before the request body is read, so that a forged POST
+# with a huge file upload is turned away without the upload being read and
+# spooled to disk first. The token is taken from an X-CSRF-Token header or,
+# failing that, from a csrf_token field (or prefix-csrf_token, for forms with
+# a prefix) at the very start of a multipart body - SafeForm renders the token first in multipart forms, so browsers
+# send it first. Peeking at the body reads only its first few kilobytes,
+# which are put back so Django can parse the whole thing as usual afterwards.
+# Other bodies, such as the urlencoded ones browsers send by default, cannot
+# hold an upload, so without the header they are left for SafeForm to check.
+#
+# Django 1.1 and 1.2 read environ['wsgi.input'] when the body is first used,
+# so that is where the head is put back. Later versions wrap the input when
+# the request is made, as request._stream, so the head is put back there.
+
+TOKEN_HEADER = 'HTTP_X_CSRF_TOKEN'
+
+boundary_re = re.compile(r'boundary="?([^";,]+)"?', re.I)
+field_name_re = re.compile(r'\bname="([^"]*)"', re.I)
+
+class ReplayStream(object):
+    "Reads from head, then carries on reading from stream"
+    
+    def __init__(self, head, stream):
+        self.head = head
+        self.stream = stream
+    
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data, self.head = self.head + self.stream.read(), ''
+            return data
+        if self.head:
+            data, self.head = self.head[:size], self.head[size:]
+            return data
+        return self.stream.read(size)
+    
+    def readline(self, size=-1):
+        if self.head:
+            end = self.head.find('\n') + 1 or len(self.head)
+            if size is not None and size >= 0:
+                end = min(end, size)
+            data, self.head = self.head[:end], self.head[end:]
+            return data
+        return self.stream.readline(size)
+
+def _read_head(stream, size):
+    chunks = []
+    while size > 0:
+        chunk = stream.read(size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+def leading_multipart_field(request, name='csrf_token', max_bytes=4096):
+    """
+    Returns the value of the first field of a multipart/form-data body if
+    it is called name or prefix-name, without Django reading the rest of
+    the body. Only works for WSGI requests, and returns None if there is no
+    such field.
+    """
+    environ = getattr(request, 'environ', None)
+    content_type = request.META.get('CONTENT_TYPE', '')
+    if environ is None or 'wsgi.input' not in environ \
+            or not content_type.startswith('multipart/form-data'):
+        return None
+    match = boundary_re.search(content_type)
+    if not match:
+        return None
+    boundary = '--' + match.group(1)
+    try:
+        content_length = int(request.META.get('CONTENT_LENGTH', 0))
+    except (ValueError, TypeError):
+        return None
+    if '_stream' in request.__dict__:
+        stream = request._stream
+        head = _read_head(stream, min(max_bytes, content_length))
+        request._stream = ReplayStream(head, stream)
+    else:
+        stream = environ['wsgi.input']
+        head = _read_head(stream, min(max_bytes, content_length))
+        environ['wsgi.input'] = ReplayStream(head, stream)
+    if not head.startswith(boundary + '\r\n'):
+        return None
+    headers_end = head.find('\r\n\r\n')
+    if headers_end == -1:
+        return None
+    headers = head[len(boundary) + 2:headers_end]
+    for line in headers.split('\r\n'):
+        if line.lower().startswith('content-disposition:'):
+            match = field_name_re.search(line)
+            if not match or 'filename=' in line.lower():
+                return None
+            field = match.group(1)
+            if field != name and not field.endswith('-' + name):
+                return None
+            break
+    else:
+        return None
+    value_end = head.find('\r\n' + boundary, headers_end + 4)
+    if value_end == -1:
+        return None
+    return head[headers_end + 4:value_end]
+
+def early_token(request):
+    "The token from the header or the leading multipart field, or None"
+    token = request.META.get(TOKEN_HEADER)
+    if token:
+        return token
+    return leading_multipart_field(request)
+
+def check_before_body(request, identifier):
+    """
+    Returns None if the request may go ahead, or a 403 response if its
+    token is missing or invalid. A valid token is kept on the request for
+    SafeForm, in case it was only sent in the header.
+    """
+    if not request.META.get(TOKEN_HEADER) and not request.META.get(
+            'CONTENT_TYPE', '').startswith('multipart/form-data'):
+        return None
+    token = early_token(request)
+    if check_csrf_tokens(request, [(token, identifier)])[0] is not None:
+        return HttpResponseForbidden('Invalid CSRF token')
+    request._csrf_early_token = token
+    return None
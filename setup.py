@@ -20,5 +20,9 @@ setup(
         'Topic :: Internet :: WWW/HTTP',
     ],
     platforms = 'Any',
-    packages = ['django_safeform']
+    packages = [
+        'django_safeform',
+        'django_safeform.management',
+        'django_safeform.management.commands',
+    ]
 )